@@ -1,7 +1,7 @@
 from adapt.intent import IntentBuilder
-from fuzzywuzzy import fuzz, process
 from mycroft.skills.core import FallbackSkill, intent_file_handler, intent_handler
 from mycroft.util.log import getLogger
+from threading import Lock, Thread
 import os
 
 from requests.exceptions import (
@@ -13,14 +13,21 @@ from requests.exceptions import (
     HTTPError)
 from requests.packages.urllib3.exceptions import MaxRetryError
 
-from .ha_client import HomeAssistantClient
+from .ha_async import SyncHomeAssistantClient
+from .ha_client import (
+    CACHE_TTL,
+    NOT_UNDERSTOOD,
+    HomeAssistantClient,
+    ServiceDispatcher)
+from .ha_metrics import Metrics
+from .ha_units import UnitNames
 
 
 __author__ = 'robconnolly, btotharye, nielstron'
 LOGGER = getLogger(__name__)
 
-# Timeout time for HA requests
-TIMEOUT = 10
+# Attributes spoken at most for one query
+MAX_SPOKEN_ATTRIBUTES = 5
 
 
 class HomeAssistantSkill(FallbackSkill):
@@ -28,26 +35,130 @@ class HomeAssistantSkill(FallbackSkill):
     def __init__(self):
         super().__init__()
         self.ha = None
-        self.enable_fallback = False
+        # None until the conversation component was looked for
+        self.enable_fallback = None
+        # settings self.ha was built with
+        self._client_config = None
+        self._client_lock = Lock()
+        self._dispatcher = None
+        # outlives rebuilt clients
+        self.metrics = Metrics()
+        self.units = UnitNames()
 
     @property
     def client(self):
+        self._setup()
+        return self.ha
+
+    def _get_bool_setting(self, name):
+        # checkboxes arrive as 'true' / 'false' strings from home.mycroft.ai
+        return str(self.settings.get(name)).lower() == 'true'
+
+    def _get_client_config(self):
         url = self.settings.get("url")
         password = self.settings.get("password")
-        if url is not None and url != '':
-            return HomeAssistantClient(url, password=password)
-        else:
-            token = os.environ.get('HASSIO_TOKEN')
-            if token is not None:
-                return HomeAssistantClient('http://hassio/homeassistant', password=token)
+        if url is None or url == '':
+            url = 'http://hassio/homeassistant'
+            password = os.environ.get('HASSIO_TOKEN')
+            if password is None:
+                return None
+        try:
+            cache_ttl = float(self.settings.get("cache_ttl", CACHE_TTL))
+        except (TypeError, ValueError):
+            cache_ttl = CACHE_TTL
+        return {
+            'url': url,
+            'password': password,
+            'cache_ttl': cache_ttl,
+            'websocket': self._get_bool_setting("websocket"),
+            'hedge': self._get_bool_setting("hedge_requests"),
+            'delta_refresh': self._get_bool_setting("delta_refresh"),
+            'async_client': self._get_bool_setting("async_client")
+        }
+
+    # Builds the shared client on first use, so its cache and
+    # connection pool live across utterances
+    def _setup(self, force=False):
+        with self._client_lock:
+            if self.ha is not None and not force:
+                return
+            config = self._get_client_config()
+            if self.ha is not None and config == self._client_config:
+                return
+            if self.ha is not None:
+                self.ha.close()
+                self.ha = None
+            self._client_config = config
+            if config is not None:
+                if config['async_client']:
+                    client_class = SyncHomeAssistantClient
+                else:
+                    client_class = HomeAssistantClient
+                kwargs = dict(password=config['password'],
+                              cache_ttl=config['cache_ttl'],
+                              websocket=config['websocket'],
+                              hedge=config['hedge'],
+                              delta_refresh=config['delta_refresh'],
+                              metrics=self.metrics)
+                try:
+                    self.ha = client_class(config['url'], **kwargs)
+                except ImportError as e:
+                    # aiohttp or websocket-client are optional
+                    LOGGER.warning('{}, using the plain client'.format(e))
+                    kwargs['websocket'] = False
+                    self.ha = HomeAssistantClient(config['url'], **kwargs)
+
+    def on_websettings_changed(self):
+        # rebuild the client only if the login settings changed
+        self._setup(force=True)
+        self.enable_fallback = None
+        self._start_prewarm()
+
+    # Sets up the client in the background, so the first utterance does
+    # not wait for the connection, the state download and the name index
+    def _start_prewarm(self):
+        Thread(target=self._prewarm, daemon=True,
+               name='HomeAssistantPrewarm').start()
+
+    def _prewarm(self):
+        try:
+            self._setup()
+            if self.ha is None:
+                return
+            self._check_fallback()
+            self.ha.prewarm()
+        except Exception as e:
+            # nobody asked yet, errors are spoken once an utterance fails
+            LOGGER.warning('Could not prepare Home Assistant: {}'.format(e))
+
+    # The conversation component is used as fallback if it is enabled in
+    # the settings and loaded at the HAServer
+    def _check_fallback(self):
+        self.enable_fallback = (
+            self._get_bool_setting('enable_fallback') and
+            self.ha.find_component('conversation'))
 
     def initialize(self):
         super().initialize()
+        self.settings.set_changed_callback(self.on_websettings_changed)
+        self._dispatcher = ServiceDispatcher(self._handle_client_exception)
         self.register_entity_file("temperature.entity")
         self.bus.on('mycroft.audio.service.pause', self._pause)
         self.bus.on('mycroft.audio.service.resume', self._resume)
+        self.bus.on('homeassistant.metrics', self.handle_metrics)
         # Needs higher priority than general fallback skills
         self.register_fallback(self.handle_fallback, 2)
+        self._start_prewarm()
+        # the unit parser is slow to load, not to hold up the first readout
+        Thread(target=self.units.load, daemon=True,
+               name='HomeAssistantUnits').start()
+
+    # Answers with the timings of the requests to the HAServer and of the
+    # name matching, as data and in the Prometheus text format
+    def handle_metrics(self, message):
+        self.bus.emit(message.response({
+            'metrics': self.metrics.snapshot(),
+            'prometheus': self.metrics.prometheus()}))
 
     # Try to find an entity on the HAServer
     # Creates dialogs for errors and speaks them
@@ -67,6 +178,53 @@ class HomeAssistantSkill(FallbackSkill):
                               "dev_name": entity})
         return ha_entity
 
+    # Executes a service at the HAServer. With background_services enabled
+    # the call is queued and this returns at once, so the confirmation can
+    # be spoken right away. Failures are spoken by _handle_client_exception
+    # once the call is done.
+    def _execute_service(self, domain, service, data=None):
+        # copy, callers keep adding dialog data to their dict
+        if data is not None:
+            data = dict(data)
+        self._run_service(self.ha.execute_service, domain, service, data)
+
+    def _execute_service_multi(self, service, entity_ids):
+        self._run_service(self.ha.execute_service_multi, service,
+                          list(entity_ids))
+
+    def _run_service(self, callback, *args):
+        if self._get_bool_setting("background_services"):
+            self._dispatcher.dispatch(callback, *args)
+        else:
+            callback(*args)
+
+    # Returns the rest of name if it starts with 'all', 'every', ...
+    # else None
+    def _strip_all_keyword(self, name):
+        words = name.lower().split()
+        keywords = [k.lower().split() for k in self.translate_list('all')]
+        # longest first, so 'all the' wins over 'all'
+        for keyword in sorted(keywords, key=len, reverse=True):
+            if keyword and words[:len(keyword)] == keyword:
+                return ' '.join(words[len(keyword):])
+        return None
+
+    # Turns every entity meant by 'all <name>' on or off, with one
+    # service call per domain. Returns False if name is no 'all <name>',
+    # a bare 'all' and names of no group or domain are looked up as a
+    # single entity
+    def _switch_all(self, name, service, domains):
+        rest = self._strip_all_keyword(name)
+        if not rest:
+            return False
+        entities = self.client.find_all_entities(rest, domains)
+        if entities == []:
+            return False
+        self._execute_service_multi(service,
+                                    [e.entity_id for e in entities])
+        self.speak_dialog(service + '.all', {'name': name})
+        return True
+
     # Calls passed method and catches often occurring exceptions
     def _handle_client_exception(self, callback, *args, **kwargs):
         try:
@@ -117,7 +275,7 @@ class HomeAssistantSkill(FallbackSkill):
 
         ha_data['brightness'] = brightness_value
         ha_data['dev_name'] = ha_entity['dev_name']
-        self.ha.execute_service("homeassistant", "turn_on", ha_data)
+        self._execute_service("homeassistant", "turn_on", ha_data)
         self.speak_dialog('homeassistant.brightness.dimmed',
                           data=ha_data)
 
@@ -171,9 +329,9 @@ class HomeAssistantSkill(FallbackSkill):
                         ha_data['brightness'] = 10
                     else:
                         ha_data['brightness'] -= brightness_value
-                    self.ha.execute_service("homeassistant",
-                                            "turn_on",
-                                            ha_data)
+                    self._execute_service("homeassistant",
+                                          "turn_on",
+                                          ha_data)
                     ha_data['dev_name'] = ha_entity['dev_name']
                     self.speak_dialog('homeassistant.brightness.decreased',
                                       data=ha_data)
@@ -195,9 +353,9 @@ class HomeAssistantSkill(FallbackSkill):
                         ha_data['brightness'] = 255
                     else:
                         ha_data['brightness'] += brightness_value
-                    self.ha.execute_service("homeassistant",
-                                            "turn_on",
-                                            ha_data)
+                    self._execute_service("homeassistant",
+                                          "turn_on",
+                                          ha_data)
                     ha_data['dev_name'] = ha_entity['dev_name']
                     self.speak_dialog('homeassistant.brightness.increased',
                                       data=ha_data)
@@ -225,19 +383,19 @@ class HomeAssistantSkill(FallbackSkill):
 
         LOGGER.debug("Triggered automation/scene/script: {}".format(ha_data))
         if "automation" in ha_entity['id']:
-            self.ha.execute_service('automation', 'trigger', ha_data)
+            self._execute_service('automation', 'trigger', ha_data)
             self.speak_dialog('homeassistant.automation.trigger',
                               data={"dev_name": ha_entity['dev_name']})
         elif "script" in ha_entity['id']:
+            self._execute_service("homeassistant", "turn_on",
+                                  data=ha_data)
             self.speak_dialog('homeassistant.automation.trigger',
                               data={"dev_name": ha_entity['dev_name']})
-            self.ha.execute_service("homeassistant", "turn_on",
-                                    data=ha_data)
         elif "scene" in ha_entity['id']:
+            self._execute_service("homeassistant", "turn_on",
+                                  data=ha_data)
             self.speak_dialog('homeassistant.device.on',
                               data=ha_entity)
-            self.ha.execute_service("homeassistant", "turn_on",
-                                    data=ha_data)
 
     def handle_sensor_intent(self, message):
         entity = message.data["Entity"]
@@ -260,23 +418,8 @@ class HomeAssistantSkill(FallbackSkill):
 
         sensor_name = unit_measurement['name']
         sensor_state = unit_measurement['state']
-        # extract unit for correct pronounciation
-        # this is fully optional
-        try:
-            from quantulum import parser
-            quantulumImport = True
-        except ImportError:
-            quantulumImport = False
-
-        if quantulumImport and unit_measurement != '':
-            quantity = parser.parse((u'{} is {} {}'.format(
-                sensor_name, sensor_state, sensor_unit)))
-            if len(quantity) > 0:
-                quantity = quantity[0]
-                if (quantity.unit.name != "dimensionless" and
-                        quantity.uncertainty <= 0.5):
-                    sensor_unit = quantity.unit.name
-                    sensor_state = quantity.value
+        # name the unit for correct pronounciation
+        sensor_unit = self.units.name(sensor_unit)
 
         self.speak_dialog('homeassistant.sensor', data={
             "dev_name": sensor_name,
@@ -316,60 +459,56 @@ class HomeAssistantSkill(FallbackSkill):
     def handle_query_attributes(self, message):
         attribute = message.data.get('attribute')
         name = message.data.get('name')
-        entities = []
+        entities = None
         if name is not None:
-            entities = self.client.find_entities(name = name)
-        else:
-            entities = self.client.find_entities()
-        if entities == []:
-            return self.speak_dialog("no.entity.by.name", data={name: name})
-        attributes = {}
-        for entity in entities:
-            candidate = process.extractOne(attribute, entity['attributes'].keys(), scorer=fuzz.partial_token_sort_ratio)
-            if candidate[1] < 60:
-                candidate = None
-            if candidate is not None:
-                self.log.info(candidate)
-                c = candidate[0]
-                entity_name = entity['attributes']['friendly_name']
-                attributes[(entity_name, c)] = entity['attributes'][c]
-        if attributes == {}:
+            entities = self.client.find_entities(name=name)
+            if entities == []:
+                return self.speak_dialog("no.entity.by.name",
+                                         data={name: name})
+        attributes = self.client.find_attributes(
+            attribute, entities, MAX_SPOKEN_ATTRIBUTES)
+        if attributes == []:
             self.log.info("Got nothin")
-        else:
-            for a in attributes:
-                data = {
-                    'name': a[0],
-                    'attribute': a[1].replace('_', ' '),
-                    'value': attributes[a]
-                }
-                self.speak_dialog('query_attribute', data)
+        for entity, key, value in attributes:
+            data = {
+                'name': entity.name,
+                'attribute': key.replace('_', ' '),
+                'value': value
+            }
+            self.speak_dialog('query_attribute', data)
 
     @intent_file_handler('turn_on.intent')
     def handle_turn_on(self, message):
         name = message.data.get("name")
-        entities = self.client.find_entities(domain=['input_boolean', 'light', 'media_player', 'switch'], name=name)
+        domains = ['input_boolean', 'light', 'media_player', 'switch']
+        if name is not None and self._switch_all(name, 'turn_on', domains):
+            return
+        entities = self.client.find_entities(domain=domains, name=name)
         if entities == []:
             return self.speak_dialog("no.entity.by.name", data={name: name})
         target = entities[0]
-        entity_id = target['entity_id']
-        domain = entity_id.split('.')[0]
+        entity_id = target.entity_id
+        domain = target.domain
         data = {'entity_id': entity_id}
-        self.client.execute_service(domain, 'turn_on', data)
-        data["name"] = target['attributes'].get('friendly_name', entity_id)
+        self._execute_service(domain, 'turn_on', data)
+        data["name"] = target.name or entity_id
         self.speak_dialog("turn_on", data)
 
     @intent_file_handler('turn_off.intent')
     def handle_turn_off(self, message):
         name = message.data.get("name")
-        entities = self.client.find_entities(domain=['input_boolean', 'light', 'media_player', 'switch'], name=name)
+        domains = ['input_boolean', 'light', 'media_player', 'switch']
+        if name is not None and self._switch_all(name, 'turn_off', domains):
+            return
+        entities = self.client.find_entities(domain=domains, name=name)
         if entities == []:
             return self.speak_dialog("no.entity.by.name", data={name: name})
         target = entities[0]
-        entity_id = target['entity_id']
-        domain = entity_id.split('.')[0]
+        entity_id = target.entity_id
+        domain = target.domain
         data = {'entity_id': entity_id}
-        self.client.execute_service(domain, 'turn_off', data)
-        data["name"] = target['attributes'].get('friendly_name', entity_id)
+        self._execute_service(domain, 'turn_off', data)
+        data["name"] = target.name or entity_id
         self.speak_dialog("turn_off", data)
 
     def _get_thermostats(self, message):
@@ -393,12 +532,12 @@ class HomeAssistantSkill(FallbackSkill):
         data = {'operation_mode': 'cool'}
         name = message.data.get("name")
         if name is None:
-            self.client.execute_service('climate', 'set_operation_mode', data)
+            self._execute_service('climate', 'set_operation_mode', data)
         else:
             target = entities[0]
-            data['entity_id'] = target['entity_id']
-            self.client.execute_service('climate', 'set_operation_mode', data)
-            name = target['attributes'].get('friendly_name', target['entity_id'])
+            data['entity_id'] = target.entity_id
+            self._execute_service('climate', 'set_operation_mode', data)
+            name = target.name or target.entity_id
         data['name'] = name or 'Thermostat'
         self.speak_dialog("climate.set_operation_mode_cool", data)
 
@@ -410,12 +549,12 @@ class HomeAssistantSkill(FallbackSkill):
         data = {'operation_mode': 'heat'}
         name = message.data.get("name")
         if name is None:
-            self.client.execute_service('climate', 'set_operation_mode', data)
+            self._execute_service('climate', 'set_operation_mode', data)
         else:
             target = entities[0]
-            data['entity_id'] = target['entity_id']
-            self.client.execute_service('climate', 'set_operation_mode', data)
-            name = target['attributes'].get('friendly_name', target['entity_id'])
+            data['entity_id'] = target.entity_id
+            self._execute_service('climate', 'set_operation_mode', data)
+            name = target.name or target.entity_id
         data['name'] = name or 'Thermostat'
         self.speak_dialog("climate.set_operation_mode_heat", data)
 
@@ -427,12 +566,12 @@ class HomeAssistantSkill(FallbackSkill):
         data = {'operation_mode': 'off'}
         name = message.data.get("name")
         if name is None:
-            self.client.execute_service('climate', 'set_operation_mode', data)
+            self._execute_service('climate', 'set_operation_mode', data)
         else:
             target = entities[0]
-            data['entity_id'] = target['entity_id']
-            self.client.execute_service('climate', 'set_operation_mode', data)
-            name = target['attributes'].get('friendly_name', target['entity_id'])
+            data['entity_id'] = target.entity_id
+            self._execute_service('climate', 'set_operation_mode', data)
+            name = target.name or target.entity_id
         data['name'] = name or 'Thermostat'
         self.speak_dialog("climate.set_operation_mode_off", data)
 
@@ -444,29 +583,49 @@ class HomeAssistantSkill(FallbackSkill):
         data = {'temperature': message.data['temperature']}
         name = message.data.get("name")
         if name is None:
-            self.client.execute_service('climate', 'set_temperature', data)
+            self._execute_service('climate', 'set_temperature', data)
         else:
             target = entities[0]
-            data['entity_id'] = target['entity_id']
-            self.client.execute_service('climate', 'set_temperature', data)
-            name = target['attributes'].get('friendly_name', target['entity_id'])
+            data['entity_id'] = target.entity_id
+            self._execute_service('climate', 'set_temperature', data)
+            name = target.name or target.entity_id
         data['name'] = name or 'Thermostat'
         self.speak_dialog("climate.set_temperature", data)
 
     def _pause(self, message = None):
-        self.client.execute_service('media_player', 'media_pause')
+        self._setup()
+        if self.ha is not None:
+            self._execute_service('media_player', 'media_pause')
 
     def _resume(self, message = None):
-        self.client.execute_service('media_player', 'media_play')
+        self._setup()
+        if self.ha is not None:
+            self._execute_service('media_player', 'media_play')
 
 
     def handle_fallback(self, message):
+        if self.enable_fallback is None:
+            # prewarming could not reach the HAServer
+            self._setup()
+            if self.ha is None:
+                return False
+            try:
+                self._check_fallback()
+            except RequestException:
+                return False
         if not self.enable_fallback:
             return False
         self._setup()
         if self.ha is None:
             self.speak_dialog('homeassistant.error.setup')
             return False
+        if self.ha.breaker.is_open:
+            # leave the utterance to other fallbacks while HA is down
+            return False
+        if (not self._get_bool_setting("fallback_all_sentences") and
+                not self.ha.mentions_entity(message.data.get('utterance'))):
+            # names nothing HA knows, not worth the round trip
+            return False
         # pass message to HA-server
         response = self._handle_client_exception(
             self.ha.engage_conversation,
@@ -475,7 +634,7 @@ class HomeAssistantSkill(FallbackSkill):
             return False
         # default non-parsing answer: "Sorry, I didn't understand that"
         answer = response.get('speech')
-        if not answer or answer == "Sorry, I didn't understand that":
+        if not answer or answer == NOT_UNDERSTOOD:
             return False
 
         asked_question = False
@@ -489,7 +648,16 @@ class HomeAssistantSkill(FallbackSkill):
     def shutdown(self):
         self.bus.remove('mycroft.audio.service.pause', self._pause)
         self.bus.remove('mycroft.audio.service.resume', self._resume)
+        self.bus.remove('homeassistant.metrics', self.handle_metrics)
         self.remove_fallback(self.handle_fallback)
+        if self._dispatcher is not None:
+            self._dispatcher.stop()
+            self._dispatcher = None
+        with self._client_lock:
+            if self.ha is not None:
+                self.ha.close()
+                self.ha = None
+            self._client_config = None
         super(HomeAssistantSkill, self).shutdown()
 
     def stop(self):
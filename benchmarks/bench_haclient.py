@@ -0,0 +1,203 @@
+"""Benchmarks of entity resolution and intent handling
+
+Generates /api/states payloads of realistic size, serves them from the
+fake Home Assistant server of the unittests and times the client lookups
+and the skill's intent handlers against it.  Reports latency percentiles
+and the peak memory allocated during a call.
+
+    python benchmarks/bench_haclient.py --sizes 100 1000 20000
+
+The intent handlers need mycroft-core, they are skipped without it.
+"""
+from unittest import mock
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ha_client import HomeAssistantClient  # noqa: E402
+from unittests.fake_homeassistant import (  # noqa: E402
+    FakeHomeAssistant, generate_states)
+
+__author__ = 'btotharye'
+
+SIZES = (100, 1000, 5000, 20000)
+PERCENTILES = (50, 90, 99)
+
+
+def measure(call, repeat):
+    """Latencies in ms and the mean peak of memory allocated during a
+    call in KiB"""
+    call()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        times.append((time.perf_counter() - start) * 1000)
+    tracemalloc.start()
+    try:
+        peaks = []
+        for _ in range(max(1, repeat // 10)):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            call()
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+    return times, sum(peaks) / len(peaks) / 1024
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def report(size, name, times, alloc):
+    print('{:>6} {:<34}'.format(size, name) +
+          ''.join('{:>10.3f}'.format(percentile(times, p))
+                  for p in PERCENTILES) +
+          '{:>12.1f}'.format(alloc))
+
+
+def queries(states, count, seed=1):
+    """Spoken-like names of random entities: lower case, words shuffled"""
+    r = random.Random(seed)
+    named = [s for s in states if not s['entity_id'].startswith('group.')]
+    picked = []
+    for state in r.sample(named, min(count, len(named))):
+        words = state['attributes']['friendly_name'].lower().split()
+        r.shuffle(words)
+        picked.append((state, ' '.join(words)))
+    return picked
+
+
+def client_benchmarks(ha, states):
+    """(name, call) of every client lookup"""
+    picked = queries(states, 20)
+    cycle = iter(range(10 ** 9))
+
+    def pick():
+        return picked[next(cycle) % len(picked)]
+
+    def find_entity():
+        state, query = pick()
+        ha.find_entity(query, [state['entity_id'].split('.')[0]])
+
+    def find_entities():
+        state, query = pick()
+        ha.find_entities(query, [state['entity_id'].split('.')[0]])
+
+    def find_entity_attr():
+        ha.find_entity_attr(pick()[0]['entity_id'])
+
+    def find_all_entities():
+        ha.find_all_entities('kitchen', ['light', 'switch'])
+
+    return [('find_entity', find_entity),
+            ('find_entities', find_entities),
+            ('find_entity_attr', find_entity_attr),
+            ('find_all_entities', find_all_entities)]
+
+
+def load_skill():
+    """The skill module, None if mycroft-core is not installed"""
+    spec = importlib.util.spec_from_file_location(
+        'homeassistant_skill', os.path.join(ROOT, '__init__.py'),
+        submodule_search_locations=[ROOT])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    try:
+        spec.loader.exec_module(module)
+    except ImportError as e:
+        del sys.modules[spec.name]
+        print('Intent handlers skipped: {}'.format(e))
+        return None
+    return module
+
+
+def intent_benchmarks(module, ha, states):
+    """(name, call) of the intent handlers, speaking nothing"""
+    skill = module.HomeAssistantSkill()
+    skill.settings = {'url': ha.url, 'password': 'password',
+                      'cache_ttl': ha.cache_ttl}
+    skill.speak = skill.speak_dialog = lambda *args, **kwargs: None
+    # the client is set up already, _setup keeps it
+    skill.ha = ha
+    by_domain = {}
+    for state, query in queries(states, len(states)):
+        by_domain.setdefault(state['entity_id'].split('.')[0], query)
+    message = mock.MagicMock()
+    # handler -> message data
+    intents = [
+        ('handle_turn_on', {'name': by_domain.get('light')}),
+        ('handle_turn_off', {'name': 'all lights'}),
+        ('handle_light_set_intent', {'entity': by_domain.get('light'),
+                                     'brightnessvalue': '50'}),
+        ('handle_light_adjust_intent', {'Entity': by_domain.get('light'),
+                                        'BrightnessValue': '10',
+                                        'DecreaseVerb': 'dim'}),
+        ('handle_sensor_intent', {'Entity': by_domain.get('sensor')}),
+        ('handle_tracker_intent',
+         {'Entity': by_domain.get('device_tracker')}),
+        ('handle_automation_intent',
+         {'Entity': by_domain.get('automation'),
+          'AutomationActionKeyword': 'trigger'}),
+        ('handle_query_attributes', {'name': by_domain.get('climate'),
+                                     'attribute': 'temperature'}),
+        ('handle_climate_set_temperature',
+         {'name': by_domain.get('climate'), 'temperature': '21'}),
+    ]
+    benchmarks = []
+    for handler, data in intents:
+        def call(handler=getattr(skill, handler), data=data):
+            message.data = dict(data)
+            handler(message)
+        benchmarks.append((handler, call))
+    return benchmarks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--repeat', type=int, default=100,
+                        help='timed calls per benchmark')
+    parser.add_argument('--cache-ttl', type=float, default=5,
+                        help='0 fetches the state for every lookup')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds the server delays every request')
+    parser.add_argument('--churn', type=float, default=0,
+                        help='state changes per second on the server')
+    parser.add_argument('--no-intents', action='store_true',
+                        help='only time the client lookups')
+    args = parser.parse_args()
+
+    module = None if args.no_intents else load_skill()
+    print('{:>6} {:<34}'.format('size', 'benchmark') +
+          ''.join('{:>10}'.format('p{} ms'.format(p)) for p in PERCENTILES) +
+          '{:>12}'.format('peak KiB'))
+    for size in args.sizes:
+        states = generate_states(size)
+        server = FakeHomeAssistant(states, latency=args.latency,
+                                   churn=args.churn).start()
+        ha = HomeAssistantClient(server.url, 'password',
+                                 cache_ttl=args.cache_ttl)
+        try:
+            benchmarks = client_benchmarks(ha, states)
+            if module is not None:
+                benchmarks += intent_benchmarks(module, ha, states)
+            for name, call in benchmarks:
+                times, alloc = measure(call, args.repeat)
+                report(size, name, times, alloc)
+        finally:
+            ha.close()
+            server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+"""asyncio variant of HomeAssistantClient on aiohttp"""
+from queue import Queue
+from threading import Lock, Thread
+from urllib.parse import quote
+import asyncio
+import time
+
+from requests import Request, Response
+from requests.exceptions import (
+    ConnectionError,
+    HTTPError,
+    InvalidURL,
+    SSLError,
+    Timeout)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    from .ha_circuit import CircuitOpenError
+    from .ha_client import (
+        CHUNK_SIZE, POOL_SIZE, TIMEOUT, HomeAssistantClient, iter_states)
+    from .ha_json import dumps, loads
+    from .ha_metrics import Metrics
+    from .ha_timeouts import AdaptiveTimeouts
+except ImportError:
+    from ha_circuit import CircuitOpenError
+    from ha_client import (
+        CHUNK_SIZE, POOL_SIZE, TIMEOUT, HomeAssistantClient, iter_states)
+    from ha_json import dumps, loads
+    from ha_metrics import Metrics
+    from ha_timeouts import AdaptiveTimeouts
+
+__author__ = 'btotharye'
+
+_loop = None
+_loop_lock = Lock()
+
+
+def get_event_loop():
+    """The event loop shared by all clients, running in its own thread"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            Thread(target=_loop.run_forever, daemon=True,
+                   name='HomeAssistantEventLoop').start()
+        return _loop
+
+
+def _response(resp, body, request):
+    """requests.Response with the status and body of an aiohttp response"""
+    r = Response()
+    r.request = request
+    r.status_code = resp.status
+    r.reason = resp.reason
+    r.url = str(resp.url)
+    r.headers.update(resp.headers)
+    r._content = body
+    return r
+
+
+class AsyncHomeAssistantClient(object):
+    """Non-blocking transport for the HA REST API
+
+    Raises the same request Exceptions as HomeAssistantClient, so callers
+    can handle errors of both alike.
+    """
+
+    def __init__(self, url, password=None, verify=True, pool_size=POOL_SIZE,
+                 metrics=None, breaker=None, timeouts=None):
+        if aiohttp is None:
+            raise ImportError('aiohttp is required for the async client')
+        self.url = url
+        self.metrics = metrics or Metrics()
+        # shared with the HomeAssistantClient probing for it
+        self.breaker = breaker
+        self.timeouts = timeouts or AdaptiveTimeouts()
+        self.verify = verify
+        self.pool_size = pool_size
+        self.headers = {
+            'x-ha-access': password,
+            'Content-Type': 'application/json',
+            # big state lists compress well
+            'Accept-Encoding': 'gzip'
+        }
+        self._session = None
+
+    def _get_session(self):
+        # the session is bound to the loop, so create it inside it
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size, ssl=None if self.verify else False)
+            self._session = aiohttp.ClientSession(
+                headers={k: v for k, v in self.headers.items()
+                         if v is not None},
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=TIMEOUT))
+        return self._session
+
+    async def _request(self, method, endpoint, path, data=None,
+                       on_chunk=None):
+        # with on_chunk, the body of a successful response is passed to it
+        # chunk by chunk as it arrives instead of being kept
+        url = '{}{}'.format(self.url, path)
+        # the skill's error dialogs read the url of the failed request
+        request = Request(method, url).prepare()
+        start = time.monotonic()
+        timeout = self.timeouts.timeout(endpoint, method)
+        try:
+            if self.breaker is not None:
+                self.breaker.check()
+            try:
+                async with self._get_session().request(
+                        method, url, data=data,
+                        timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                    if on_chunk is None or resp.status >= 400:
+                        body = await resp.read()
+                        size = len(body)
+                    else:
+                        body = b''
+                        size = 0
+                        async for chunk in resp.content.iter_chunked(
+                                CHUNK_SIZE):
+                            size += len(chunk)
+                            on_chunk(chunk)
+                    r = _response(resp, body, request)
+            except asyncio.TimeoutError as e:
+                raise Timeout(e, request=request)
+            except aiohttp.InvalidURL as e:
+                raise InvalidURL(e, request=request)
+            except aiohttp.ClientSSLError as e:
+                raise SSLError(e, request=request)
+            except aiohttp.ClientError as e:
+                raise ConnectionError(e, request=request)
+        except Exception as e:
+            if self.breaker is not None:
+                self.breaker.failure(e)
+            if isinstance(e, Timeout) and not isinstance(
+                    e, CircuitOpenError):
+                self.timeouts.observe(endpoint, timeout)
+            self.metrics.request(endpoint, type(e).__name__,
+                                 time.monotonic() - start)
+            raise
+        if self.breaker is not None:
+            self.breaker.success()
+        self.timeouts.observe(endpoint, time.monotonic() - start)
+        self.metrics.request(endpoint, r.status_code,
+                             time.monotonic() - start, size)
+        r.raise_for_status()
+        return r
+
+    async def _fetch_state(self):
+        """Download the state of all entities from the HA-Server
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
+        r = await self._request('GET', 'states', '/api/states')
+        return loads(r.content)
+
+    async def _stream_state(self, on_chunk):
+        """Download the state of all entities, passing the body to
+        on_chunk as it arrives
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
+        await self._request('GET', 'states', '/api/states',
+                            on_chunk=on_chunk)
+
+    async def _fetch_entity_state(self, entity_id):
+        """Download the state of one entity, None if there is no such entity
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
+        try:
+            r = await self._request('GET', 'state',
+                                    '/api/states/{}'.format(entity_id))
+        except HTTPError as e:
+            if e.response.status_code == 404:
+                return None
+            raise
+        return loads(r.content)
+
+    async def _fetch_logbook(self, since):
+        """Download the logbook entries from the ISO timestamp since on
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
+        r = await self._request('GET', 'logbook',
+                                '/api/logbook/{}'.format(quote(since)))
+        return loads(r.content)
+
+    async def execute_service(self, domain, service, data=None):
+        """Execute service at HAServer
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
+        if data is not None:
+            data = dumps(data)
+        return await self._request(
+            'POST', 'services', '/api/services/{}/{}'.format(domain, service),
+            data)
+
+    async def find_component(self, component):
+        """Check if a component is loaded at the HA-Server
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
+        return component in await self._fetch_components()
+
+    async def _fetch_components(self):
+        r = await self._request('GET', 'components', '/api/components')
+        return loads(r.content)
+
+    async def engage_conversation(self, utterance):
+        """Engage the conversation component at the Home Assistant server
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
+        r = await self._request('POST', 'conversation',
+                                '/api/conversation/process',
+                                dumps({"text": utterance}))
+        return loads(r.content)['speech']['plain']
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class SyncHomeAssistantClient(HomeAssistantClient):
+    """HomeAssistantClient doing its requests on the shared event loop
+
+    Drop-in for the intent handlers: every method blocks as before.
+    submit() starts a request without waiting, so it can overlap with
+    speaking or other requests.
+    """
+
+    def __init__(self, url, password=None, verify=True, **kwargs):
+        super().__init__(url, password, verify, **kwargs)
+        self.async_client = AsyncHomeAssistantClient(
+            url, password, verify, kwargs.get('pool_size', POOL_SIZE),
+            self.metrics, self.breaker, self.timeouts)
+        self.loop = get_event_loop()
+
+    def submit(self, method, *args, **kwargs):
+        """Run a method of the async client, returns a Future"""
+        coro = getattr(self.async_client, method)(*args, **kwargs)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def _run(self, method, *args, **kwargs):
+        return self.submit(method, *args, **kwargs).result()
+
+    def _fetch_state(self):
+        return self._run('_fetch_state')
+
+    def _stream_state(self, domains=None, attributes=None):
+        # the loop receives the chunks, this thread decodes them
+        chunks = Queue()
+        future = self.submit('_stream_state', chunks.put)
+        future.add_done_callback(lambda _: chunks.put(None))
+        try:
+            yield from iter_states(iter(chunks.get, None), domains,
+                                   attributes)
+        except ValueError:
+            # a body cut off by a failed request, raise the failure
+            future.result()
+            raise
+        future.result()
+
+    def _fetch_entity_state(self, entity_id):
+        return self._run('_fetch_entity_state', entity_id)
+
+    def _fetch_logbook(self, since):
+        return self._run('_fetch_logbook', since)
+
+    def execute_service(self, domain, service, data=None):
+        try:
+            return self._run('execute_service', domain, service, data)
+        finally:
+            # the service call most likely changed some state
+            self.invalidate_cache()
+
+    def _fetch_components(self):
+        return self._run('_fetch_components')
+
+    def _process_conversation(self, utterance):
+        return self._run('engage_conversation', utterance)
+
+    def close(self):
+        super().close()
+        self.submit('close').result(TIMEOUT)
@@ -0,0 +1,46 @@
+"""Small least recently used cache with expiring entries"""
+from collections import OrderedDict
+from threading import Lock
+import time
+
+__author__ = 'btotharye'
+
+
+class LRUCache(object):
+    """Keeps up to maxsize values for ttl seconds each
+
+    The least recently used entry is dropped when full.  get() returns
+    default for missing and expired keys.
+    """
+
+    def __init__(self, maxsize=256, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (expiry time, value), least recently used first
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,103 @@
+"""Circuit breaker failing requests at once while HA is unreachable"""
+from threading import Event, Lock, Thread
+import logging
+
+from requests.exceptions import ConnectionError, ProxyError, SSLError, Timeout
+
+__author__ = 'btotharye'
+LOGGER = logging.getLogger(__name__)
+
+# Timeouts or connection errors in a row that open the circuit
+FAILURE_THRESHOLD = 3
+# Seconds between probes while open, doubled up to the maximum
+PROBE_INTERVAL = 2
+PROBE_MAX_INTERVAL = 30
+
+
+class CircuitOpenError(ConnectionError, Timeout):
+    """Raised instead of a request while the HAServer is unreachable
+
+    A Timeout like requests' ConnectTimeout, so it is handled the same
+    way as the timeouts that opened the circuit.
+    """
+
+
+class CircuitBreaker(object):
+    """Counts failed requests and stops sending them while HA is down
+
+    After threshold timeouts or connection errors in a row the circuit
+    opens and check() raises CircuitOpenError.  probe() is then called in
+    a background thread until it returns True, which closes the circuit
+    again.  Any answer of the server closes it as well.
+    """
+
+    def __init__(self, probe, threshold=FAILURE_THRESHOLD):
+        self._probe = probe
+        self.threshold = threshold
+        self.is_open = False
+        self._failures = 0
+        self._lock = Lock()
+        self._stopping = Event()
+        self._thread = None
+
+    def check(self):
+        if self.is_open:
+            raise CircuitOpenError('Home Assistant is unreachable')
+
+    def success(self):
+        """The server answered, whatever the status"""
+        with self._lock:
+            self._failures = 0
+            if self.is_open:
+                self._close()
+
+    def failure(self, error):
+        """A request failed, only counted for errors of an unreachable
+        server"""
+        if not isinstance(error, (ConnectionError, Timeout)):
+            return
+        # ConnectionErrors as well, but a bad certificate or proxy stays
+        # bad, no probe would ever close the circuit again
+        if isinstance(error, (SSLError, ProxyError)):
+            return
+        with self._lock:
+            self._failures += 1
+            if self.is_open or self._failures < self.threshold:
+                return
+            LOGGER.warning('Home Assistant unreachable, failing requests '
+                           'until it answers again: {}'.format(error))
+            self.is_open = True
+            if self._thread is None:
+                self._thread = Thread(target=self._run_probes, daemon=True,
+                                      name='HomeAssistantProbe')
+                self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(PROBE_MAX_INTERVAL)
+
+    def _close(self):
+        LOGGER.info('Home Assistant reachable again')
+        self.is_open = False
+        self._failures = 0
+
+    def _run_probes(self):
+        delay = PROBE_INTERVAL
+        while not self._stopping.wait(delay):
+            try:
+                alive = self._probe()
+            except Exception:
+                alive = False
+            # decided under the lock, so a circuit opening again meanwhile
+            # either keeps this thread or starts a new one
+            with self._lock:
+                if alive and self.is_open:
+                    self._close()
+                if not self.is_open:
+                    self._thread = None
+                    return
+            delay = min(delay * 2, PROBE_MAX_INTERVAL)
+        with self._lock:
+            self._thread = None
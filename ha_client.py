@@ -1,55 +1,655 @@
-from urllib.parse import urlparse
+from urllib.parse import quote, urlparse
 
-from requests import get, post
-from fuzzywuzzy import fuzz, process
+from collections import OrderedDict
+from concurrent.futures import (
+    FIRST_COMPLETED, Future, ThreadPoolExecutor, wait)
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError, RequestException, Timeout
+from requests.packages.urllib3.util.retry import Retry
+from fuzzywuzzy import fuzz, utils
+from queue import Queue
+from threading import Lock, Thread
+import codecs
 import json
+import logging
+import re
+import time
+
+try:
+    from .ha_cache import LRUCache
+    from .ha_circuit import CircuitBreaker, CircuitOpenError
+    from .ha_index import (
+        ATTRIBUTE_SCORE, ENTITY_ID, AttributeIndex, EntityIndex,
+        default_scorer, name_tokens, normalize)
+    from .ha_json import dumps, loads
+    from .ha_metrics import SIZE_BUCKETS, Metrics
+    from .ha_timeouts import AdaptiveTimeouts
+    from .ha_websocket import HomeAssistantWebsocket
+except ImportError:
+    from ha_cache import LRUCache
+    from ha_circuit import CircuitBreaker, CircuitOpenError
+    from ha_index import (
+        ATTRIBUTE_SCORE, ENTITY_ID, AttributeIndex, EntityIndex,
+        default_scorer, name_tokens, normalize)
+    from ha_json import dumps, loads
+    from ha_metrics import SIZE_BUCKETS, Metrics
+    from ha_timeouts import AdaptiveTimeouts
+    from ha_websocket import HomeAssistantWebsocket
 
 __author__ = 'btotharye'
+LOGGER = logging.getLogger(__name__)
 
 # Timeout time for HA requests
 TIMEOUT = 10
+# Seconds a downloaded state snapshot is reused before fetching it again
+CACHE_TTL = 5
+# Kept-alive connections to the HA-Server
+POOL_SIZE = 4
+# Retries of failed connections and idempotent requests
+RETRIES = 2
+# Score a name needs to be taken for a whole domain, e.g. 'lights'
+DOMAIN_SCORE = 80
+# Bytes read at once when streaming the state list
+CHUNK_SIZE = 64 * 1024
+# Answer of the conversation component to utterances it did not get
+NOT_UNDERSTOOD = "Sorry, I didn't understand that"
+# Such utterances remembered, and for how many seconds
+CONVERSATION_CACHE_SIZE = 256
+CONVERSATION_CACHE_TTL = 600
+# Seconds a remembered answer is trusted before the components are checked
+# again, a new one may understand it.  The websocket reports them at once
+COMPONENT_CHECK_INTERVAL = 60
+# With delta refresh, all states are downloaded again after this many
+# seconds, or if more entities changed than are worth a request each
+RESYNC_INTERVAL = 300
+MAX_REFETCH = 20
+# Attributes the skill uses, streamed lookups keep only these
+STATE_ATTRIBUTES = ('friendly_name', 'brightness', 'unit_of_measurement',
+                    'entity_id')
+
+# Whitespace and separators between the states of the list
+_SEPARATORS = re.compile(r'[\s,\[]*')
+
+
+def iter_states(chunks, domains=None, attributes=None):
+    """Decode a /api/states response incrementally
+
+    chunks are the bytes of the response as they arrive.  Yields every
+    state object in domains (all if None) as soon as it is complete,
+    states of other domains are dropped right away.
+    If attributes are given, only those attributes are kept.
+    """
+    if isinstance(domains, str):
+        domains = [domains]
+    text = codecs.getincrementaldecoder('utf-8')()
+    decoder = json.JSONDecoder()
+    buf = ''
+    for chunk in chunks:
+        buf += text.decode(chunk)
+        pos = 0
+        while True:
+            pos = _SEPARATORS.match(buf, pos).end()
+            if pos == len(buf) or buf[pos] == ']':
+                break
+            try:
+                state, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # state continues in the next chunk
+                break
+            if (domains is not None and
+                    state['entity_id'].split('.')[0] not in domains):
+                continue
+            if attributes is not None:
+                state['attributes'] = {
+                    k: v for k, v in state['attributes'].items()
+                    if k in attributes}
+            yield state
+        buf = buf[pos:]
+    if buf.strip() not in ('', ']'):
+        raise ValueError('Incomplete state list from Home Assistant')
+
+
+class Entity(object):
+    """Compact record of one entity's state
+
+    The fields the skill looks at are kept in slots, the rest of the
+    state object (context, timestamps) is dropped.  A record built from
+    a state with only some attributes loads all of them through
+    loader(entity_id) when they are first asked for.
+    """
+    __slots__ = ('entity_id', 'domain', 'object_id', 'name', 'state',
+                 'brightness', 'unit_of_measurement', '_attributes',
+                 '_loader')
+
+    def __init__(self, entity_id, state, attributes, loader=None):
+        self.entity_id = entity_id
+        self.domain, _, self.object_id = entity_id.partition('.')
+        self.name = attributes.get('friendly_name')
+        self.state = state
+        self.brightness = attributes.get('brightness')
+        self.unit_of_measurement = attributes.get('unit_of_measurement')
+        self._attributes = attributes
+        self._loader = loader
+
+    @classmethod
+    def from_state(cls, state, loader=None):
+        """Record of a state object as returned by the HA API"""
+        return cls(state['entity_id'], state['state'], state['attributes'],
+                   loader)
+
+    @property
+    def attributes(self):
+        if self._loader is not None:
+            state = self._loader(self.entity_id)
+            if state is not None:
+                self._attributes = state['attributes']
+            self._loader = None
+        return self._attributes
+
+    def __repr__(self):
+        return 'Entity({!r}, {!r})'.format(self.entity_id, self.state)
+
+
+class ServiceDispatcher(object):
+    """Runs queued calls one after another in a background thread
+
+    Every call goes through runner(callback, *args, **kwargs), which is
+    expected to report failures, e.g. the skill's exception handler.
+    """
+
+    def __init__(self, runner):
+        self._runner = runner
+        self._queue = Queue()
+        self._thread = Thread(target=self._work, daemon=True,
+                              name='HomeAssistantDispatcher')
+        self._thread.start()
+
+    def dispatch(self, callback, *args, **kwargs):
+        self._queue.put((callback, args, kwargs))
+
+    def stop(self):
+        """Finish the queued calls and end the thread"""
+        self._queue.put(None)
+        self._thread.join(TIMEOUT)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            callback, args, kwargs = item
+            try:
+                self._runner(callback, *args, **kwargs)
+            except Exception:
+                LOGGER.exception('Background call to Home Assistant failed')
+
+
+class SingleFlight(object):
+    """Runs a call once for all threads asking for it at the same time
+
+    Threads calling do() with a key while a call of that key is running
+    wait for it and share its result or exception.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # key -> Future of the running call
+        self._calls = {}
+
+    def do(self, key, function):
+        """Returns the result and whether it came from another thread"""
+        with self._lock:
+            future = self._calls.get(key)
+            shared = future is not None
+            if not shared:
+                future = self._calls[key] = Future()
+        if shared:
+            return future.result(), True
+        try:
+            result = function()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return result, False
 
 
 class HomeAssistantClient(object):
 
-    def __init__(self, url, password=None, verify=True):
+    def __init__(self, url, password=None, verify=True, cache_ttl=CACHE_TTL,
+                 websocket=False, pool_size=POOL_SIZE, retries=RETRIES,
+                 scorer=None, metrics=None, timeout=TIMEOUT, hedge=False,
+                 delta_refresh=False):
         self.url = url
         self.ssl = urlparse(self.url).scheme == 'https'
         self.verify = verify
         self.headers = {
             'x-ha-access': password,
-            'Content-Type': 'application/json'
+            'Content-Type': 'application/json',
+            # big state lists compress well
+            'Accept-Encoding': 'gzip'
         }
+        # one keep-alive session, so TCP and TLS handshakes are reused
+        self.pool_size = pool_size
+        self.session = Session()
+        self.session.headers.update(self.headers)
+        self.session.verify = verify
+        # read timeouts are not retried, they surface as Timeout
+        retry = Retry(total=retries, read=False, backoff_factor=0.3,
+                      status_forcelist=(502, 503, 504),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.cache_ttl = cache_ttl
+        # entity_id -> Entity of the last downloaded snapshot
+        self._states = {}
+        self._states_time = None
+        self._lock = Lock()
+        # concurrent refreshes of the snapshot share one request
+        self._flights = SingleFlight()
+        # refresh only the entities the logbook lists as changed
+        self.delta_refresh = delta_refresh
+        # newest last_updated of the snapshot, in the server's clock, and
+        # when the last full snapshot was downloaded
+        self._synced_until = None
+        self._resync_time = None
+        # name index of the cached states, built on first lookup
+        self._index = None
+        # attribute key index of the cached states, built on first query
+        self._attribute_index = None
+        # words of the friendly names of the last index, kept when the
+        # cache expires as names seldom change
+        self._name_tokens = None
+        # fuzzy matching backend, see ha_index
+        self.scorer = scorer or default_scorer()
+        # timings of requests and matching, see ha_metrics
+        self.metrics = metrics or Metrics()
+        # fails requests at once while the HAServer is unreachable
+        self.breaker = CircuitBreaker(self._probe)
+        # per endpoint timeouts, starting at timeout
+        self.timeouts = AdaptiveTimeouts(timeout)
+        # send idempotent reads again if they take unusually long
+        self.hedge = hedge
+        # utterances the conversation component did not understand
+        self._not_understood = LRUCache(CONVERSATION_CACHE_SIZE,
+                                        CONVERSATION_CACHE_TTL)
+        # components loaded at the last check, and when it was
+        self._components = None
+        self._components_time = None
+        # runs concurrent service calls, created on first use
+        self._executor = None
+        self._mirror = None
+        if websocket:
+            self._mirror = HomeAssistantWebsocket(self, password)
+            self._mirror.start()
 
-    def _get_state(self):
-        """Get state object
+    def close(self):
+        """Stop the websocket mirror and close the pooled connections"""
+        if self._mirror is not None:
+            self._mirror.stop()
+            self._mirror = None
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self.breaker.stop()
+        self.session.close()
+
+    def _cache_fresh(self):
+        # a synced websocket mirror is always up to date
+        if self._mirror is not None and self._mirror.synced:
+            return True
+        return (self._states_time is not None and
+                time.monotonic() - self._states_time < self.cache_ttl)
+
+    def _apply_snapshot(self, states):
+        # ISO timestamps of HA are all UTC, so they sort as strings
+        synced = max((s.get('last_updated') or '' for s in states),
+                     default='')
+        states = {s['entity_id']: Entity.from_state(s) for s in states}
+        with self._lock:
+            self._states = states
+            self._states_time = self._resync_time = time.monotonic()
+            self._synced_until = synced or None
+            self._index = None
+            self._attribute_index = None
+        return states
+
+    def _apply_state_change(self, entity_id, new_state):
+        with self._lock:
+            old = self._states.get(entity_id)
+            new = None
+            if new_state is None:
+                # entity was removed
+                self._states.pop(entity_id, None)
+            else:
+                new = self._states[entity_id] = Entity.from_state(new_state)
+            if old is None or new is None or old.name != new.name:
+                self._index = None
+            if (old is None or new is None or
+                    old.attributes.keys() != new.attributes.keys()):
+                self._attribute_index = None
+
+    def _get_index(self, domains=None, attributes=STATE_ATTRIBUTES):
+        """Get the name index and the Entities it was built from
+
+        Without a cache (cache_ttl 0 and no websocket mirror) only the
+        states in domains are streamed, keeping just the given attributes.
+        The others are fetched if an Entity's attributes are asked for.
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
+        if self.cache_ttl <= 0 and not self._cache_fresh():
+            loader = self._fetch_entity_state if attributes else None
+            states = {s['entity_id']: Entity.from_state(s, loader)
+                      for s in self._stream_state(domains, attributes)}
+            with self.metrics.timer('index_build_seconds'):
+                index = EntityIndex(states.values())
+            if domains is None:
+                self._name_tokens = index.tokens
+            return states, index
+        self._get_state_map()
+        with self._lock:
+            if self._index is None:
+                with self.metrics.timer('index_build_seconds'):
+                    self._index = EntityIndex(self._states.values())
+                self._name_tokens = self._index.tokens
+            return self._states, self._index
+
+    def prewarm(self):
+        """Load the state and build the name index ahead of the first lookup
+
+        Without a cache there is nothing to keep but the words of the
+        names, which mentions_entity looks at.
 
         Throws request Exceptions
         (Subclasses of ConnectionError or RequestException,
           raises HTTPErrors if non-Ok status code)
         """
-        if self.ssl:
-            req = get("{}/api/states".format(self.url), headers=self.headers,
-                      verify=self.verify, timeout=TIMEOUT)
+        if self.cache_ttl > 0 or self._mirror is not None:
+            self._get_index()
         else:
-            req = get("{}/api/states".format(self.url), headers=self.headers,
-                      timeout=TIMEOUT)
+            self._get_index(attributes=('friendly_name',))
+
+    def mentions_entity(self, utterance):
+        """Check if an utterance contains a word of any friendly name
+
+        Only the names of the last lookup are looked at, without a request.
+        True as long as no names are known.
+        """
+        tokens = self._name_tokens
+        if tokens is None:
+            return True
+        return not tokens.isdisjoint(name_tokens(normalize(utterance)))
+
+    def invalidate_cache(self):
+        """Drop the cached state snapshot, the next lookup refetches it"""
+        self._states_time = None
+
+    def _get_state(self):
+        """Get all Entities, served from the cache while it is fresh
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
+        states = self._get_state_map()
+        with self._lock:
+            return list(states.values())
+
+    def _get_state_map(self):
+        """Get Entities keyed by entity_id, refreshing a stale cache
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
+        if self._cache_fresh():
+            self.metrics.inc('state_cache_total', result='hit')
+            return self._states
+        states, shared = self._flights.do('states', self._refresh_state)
+        self.metrics.inc('state_cache_total',
+                         result='shared' if shared else 'miss')
+        return states
+
+    def _refresh_state(self):
+        if self.delta_refresh and self._synced_until is not None and (
+                time.monotonic() - self._resync_time < RESYNC_INTERVAL):
+            try:
+                states = self._refresh_changes()
+            except HTTPError as e:
+                # most likely the logbook component is not loaded
+                LOGGER.warning('Delta refresh failed, downloading all '
+                               'states from now on: {}'.format(e))
+                self.delta_refresh = False
+                states = None
+            if states is not None:
+                return states
+        return self._apply_snapshot(self._fetch_state())
+
+    def _refresh_changes(self):
+        """Merge the entities changed since the last refresh into the
+        snapshot, returns None if all states should be downloaded instead
+
+        The logbook leaves out attribute changes and sensors with a unit,
+        which is why all states are downloaded every RESYNC_INTERVAL.
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
+        synced = self._synced_until
+        changed = set()
+        for entry in self._fetch_logbook(synced):
+            entity_id = entry.get('entity_id')
+            if entity_id is not None:
+                changed.add(entity_id)
+            elif entry.get('domain') == 'homeassistant':
+                # restarted, anything may have changed meanwhile
+                return None
+            synced = max(synced, entry.get('when') or '')
+        if len(changed) > MAX_REFETCH:
+            return None
+        for entity_id in sorted(changed):
+            state = self._fetch_entity_state(entity_id)
+            if state is not None:
+                synced = max(synced, state.get('last_updated') or '')
+            self._apply_state_change(entity_id, state)
+        with self._lock:
+            self._synced_until = synced
+            self._states_time = time.monotonic()
+            return self._states
+
+    def _request(self, method, endpoint, path, **kwargs):
+        # session.get or .post.  With hedging, a read taking longer than
+        # usual is sent a second time and the first answer is taken.
+        if self.hedge and method == 'get' and not kwargs.get('stream'):
+            delay = self.timeouts.hedge_delay(endpoint)
+            if delay is not None:
+                return self._hedged_request(delay, method, endpoint, path,
+                                            **kwargs)
+        return self._send(method, endpoint, path, **kwargs)
+
+    def _hedged_request(self, delay, *args, **kwargs):
+        executor = self._get_executor()
+        first = executor.submit(self._send, *args, **kwargs)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        self.metrics.inc('hedged_requests_total', endpoint=args[1])
+        pending = {first, executor.submit(self._send, *args, **kwargs)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+        # both failed
+        return first.result()
+
+    def _send(self, method, endpoint, path, **kwargs):
+        # One request, timed in the metrics by endpoint and failing at
+        # once while the circuit breaker is open.
+        # Streamed requests are timed until the headers arrived.
+        start = time.monotonic()
+        status = None
+        timeout = self.timeouts.timeout(endpoint, method)
+        try:
+            self.breaker.check()
+            req = getattr(self.session, method)(
+                '{}{}'.format(self.url, path), timeout=timeout, **kwargs)
+            status = req.status_code
+            self.breaker.success()
+            self.timeouts.observe(endpoint, time.monotonic() - start)
+            return req
+        except Exception as e:
+            status = type(e).__name__
+            self.breaker.failure(e)
+            if isinstance(e, Timeout) and not isinstance(
+                    e, CircuitOpenError):
+                # wait longer next time, the server may just be slow
+                self.timeouts.observe(endpoint, timeout)
+            raise
+        finally:
+            size = None
+            # streamed bodies are counted as they are read
+            if isinstance(status, int) and not kwargs.get('stream'):
+                size = len(req.content)
+            self.metrics.request(endpoint, status,
+                                 time.monotonic() - start, size)
+
+    def _probe(self):
+        # True if the HAServer answers at all, even with an error
+        try:
+            self.session.get('{}/api/'.format(self.url),
+                             timeout=self.timeouts.default)
+        except RequestException:
+            return False
+        return True
+
+    def _fetch_state(self):
+        """Download the state of all entities from the HA-Server
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
+        req = self._request('get', 'states', '/api/states')
+        req.raise_for_status()
+        return loads(req.content)
+
+    def _stream_state(self, domains=None, attributes=None):
+        """Download the state of the entities in domains, yielding each
+        state as soon as it has arrived
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
+        size = 0
+
+        def chunks():
+            nonlocal size
+            for chunk in req.iter_content(CHUNK_SIZE):
+                size += len(chunk)
+                yield chunk
+
+        with self._request('get', 'states', '/api/states',
+                           stream=True) as req:
+            req.raise_for_status()
+            yield from iter_states(chunks(), domains, attributes)
+        self.metrics.observe('response_bytes', size, SIZE_BUCKETS,
+                             endpoint='states')
+
+    def _fetch_entity_state(self, entity_id):
+        """Download the state of one entity, None if there is no such entity
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
+        req = self._request('get', 'state',
+                            '/api/states/{}'.format(entity_id))
+        if req.status_code == 404:
+            return None
         req.raise_for_status()
-        return req.json()
+        return loads(req.content)
+
+    def _fetch_logbook(self, since):
+        """Download the logbook entries from the ISO timestamp since on
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
+        req = self._request('get', 'logbook',
+                            '/api/logbook/{}'.format(quote(since)))
+        req.raise_for_status()
+        return loads(req.content)
 
     def find_entities(self, name=None, domain=None):
+        if name is not None:
+            # all attributes, callers look at any of them
+            states, index = self._get_index(domain, attributes=None)
+            # scored against the entity_id, like process.extractOne on
+            # a {friendly_name: entity_id} dict does
+            with self.metrics.timer('match_seconds', method='find_entities'):
+                entry, _ = index.best_match(
+                    normalize(name), domain, self.scorer, keys=(ENTITY_ID,),
+                    partial=True)
+            state = states.get(entry[0]) if entry else None
+            return [state] if state is not None else []
         entities = self._get_state()
         if domain is not None:
             if isinstance(domain, str):
-                entities = [e for e in entities if e['entity_id'].startswith(domain)]
+                entities = [e for e in entities if e.entity_id.startswith(domain)]
             elif isinstance(domain, list):
-                entities = [e for e in entities if e['entity_id'].split('.')[0] in domain]
-        if name is not None:
-            entities_by_name = {e['attributes'].get('friendly_name'): e['entity_id']  for e in entities if e['attributes'].get('friendly_name') is not None}
-            entity_id = process.extractOne(name, entities_by_name, scorer=fuzz.partial_token_sort_ratio)
-            entities = [e for e in entities if e['entity_id'] == entity_id[0]]
+                entities = [e for e in entities if e.domain in domain]
         return entities
 
+    def find_attributes(self, attribute, entities=None, limit=None):
+        """Find the attribute most like the spoken one
+
+        Looks at the given Entities, or else at every entity having the
+        best matching attribute key.  Returns up to limit
+        (Entity, attribute key, value) tuples in state order.
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
+        if entities is not None:
+            found = []
+            for entity in entities:
+                index = AttributeIndex([entity])
+                key = index.best_key(attribute, ATTRIBUTE_SCORE)
+                if key is not None:
+                    found.append((entity, key, entity.attributes[key]))
+            return found[:limit]
+        states, index = self._get_attribute_index()
+        with self.metrics.timer('match_seconds', method='find_attributes'):
+            key = index.best_key(attribute, ATTRIBUTE_SCORE)
+        if key is None:
+            return []
+        entities = [states[entity_id] for entity_id in index.keys[key]]
+        return [(entity, key, entity.attributes[key])
+                for entity in entities[:limit]]
+
+    def _get_attribute_index(self):
+        # dropped on every refresh, so kept even without a cache
+        self._get_state_map()
+        with self._lock:
+            if self._attribute_index is None:
+                self._attribute_index = AttributeIndex(self._states.values())
+            return self._states, self._attribute_index
+
     def find_entity(self, entity, types):
         """Find entity with specified name, fuzzy matching
 
@@ -57,42 +657,73 @@ class HomeAssistantClient(object):
         (Subclasses of ConnectionError or RequestException,
           raises HTTPErrors if non-Ok status code)
         """
-        json_data = self._get_state()
+        states, index = self._get_index(types)
+        # something like temperature outside
+        # should score on "outside temperature sensor"
+        # and repetitions should not count on my behalf
         # require a score above 50%
-        best_score = 50
-        best_entity = None
-        if json_data:
-            for state in json_data:
-                try:
-                    if state['entity_id'].split(".")[0] in types:
-                        # something like temperature outside
-                        # should score on "outside temperature sensor"
-                        # and repetitions should not count on my behalf
-                        score = fuzz.token_sort_ratio(
-                            entity,
-                            state['attributes']['friendly_name'].lower())
-                        if score > best_score:
-                            best_score = score
-                            best_entity = {
-                                "id": state['entity_id'],
-                                "dev_name": state['attributes']
-                                ['friendly_name'],
-                                "state": state['state'],
-                                "best_score": best_score}
-                        score = fuzz.token_sort_ratio(
-                            entity,
-                            state['entity_id'].lower())
-                        if score > best_score:
-                            best_score = score
-                            best_entity = {
-                                "id": state['entity_id'],
-                                "dev_name": state['attributes']
-                                ['friendly_name'],
-                                "state": state['state'],
-                                "best_score": best_score}
-                except KeyError:
-                    pass
-            return best_entity
+        with self.metrics.timer('match_seconds', method='find_entity'):
+            entry, best_score = index.best_match(
+                normalize(entity), types, self.scorer, threshold=50)
+        found = states.get(entry[0]) if entry else None
+        if found is None:
+            return None
+        return {
+            "id": found.entity_id,
+            "dev_name": found.name,
+            "state": found.state,
+            "best_score": best_score}
+
+    def find_all_entities(self, name, domains):
+        """Find every entity meant by 'all <name>'
+
+        The name of a domain (like 'lights') stands for all entities of
+        that domain.  Any other name is matched against the groups, and
+        the group's members in the domains are returned, only those of
+        the domains named as well if any (like 'kitchen lights').  An
+        empty name finds nothing, a bare 'all' must not switch the whole
+        house.
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
+        if isinstance(domains, str):
+            domains = [domains]
+        words = normalize(name).split()
+        if not words:
+            return []
+        # words naming a domain, and which domains they name
+        named = {w: [d for d in domains
+                     if fuzz.ratio(w, normalize(d)) >= DOMAIN_SCORE]
+                 for w in words}
+        matched = [d for d in domains if any(d in n for n in named.values())]
+        if all(named.values()):
+            return [e for e in self._get_state() if e.domain in matched]
+        group = self.find_entity(name, ['group'])
+        if group is None:
+            return []
+        states = self._get_state_map()
+        members = self._group_members(group['id'], states, set())
+        wanted = matched or domains
+        return [states[m] for m in members
+                if m in states and m.split('.')[0] in wanted]
+
+    def _group_members(self, group_id, states, seen):
+        # nested groups are expanded, every entity is returned once
+        members = []
+        group = states.get(group_id)
+        if group is None:
+            return members
+        for member in group.attributes.get('entity_id', []):
+            if member in seen:
+                continue
+            seen.add(member)
+            if member.startswith('group.'):
+                members.extend(self._group_members(member, states, seen))
+            else:
+                members.append(member)
+        return members
 
     def find_entity_attr(self, entity):
         """checking the entity attributes to be used in the response dialog.
@@ -101,33 +732,44 @@ class HomeAssistantClient(object):
         (Subclasses of ConnectionError or RequestException,
           raises HTTPErrors if non-Ok status code)
         """
-        json_data = self._get_state()
-
-        if json_data:
-            for attr in json_data:
-                if attr['entity_id'] == entity:
-                    entity_attrs = attr['attributes']
-                    try:
-                        if attr['entity_id'].startswith('light.'):
-                            # Not all lamps do have a color
-                            unit_measur = entity_attrs['brightness']
-                        else:
-                            unit_measur = entity_attrs['unit_of_measurement']
-                    except KeyError:
-                        unit_measur = None
-                    # IDEA: return the color if available
-                    # TODO: change to return the whole attr dictionary =>
-                    # free use within handle methods
-                    sensor_name = entity_attrs['friendly_name']
-                    sensor_state = attr['state']
-                    entity_attr = {
-                        "unit_measure": unit_measur,
-                        "name": sensor_name,
-                        "state": sensor_state
-                    }
-                    return entity_attr
+        if self._cache_fresh():
+            attr = self._states.get(entity)
+            stale = attr is not None and self._unlogged(attr)
+        else:
+            stale = True
+        if stale:
+            # the id is known, so fetching this one entity is enough
+            attr = self._fetch_entity_state(entity)
+            if attr is not None:
+                attr = Entity.from_state(attr)
+        if attr is not None:
+            if attr.domain == 'light':
+                # Not all lamps do have a color
+                unit_measur = attr.brightness
+            else:
+                unit_measur = attr.unit_of_measurement
+            # IDEA: return the color if available
+            # TODO: change to return the whole attr dictionary =>
+            # free use within handle methods
+            sensor_name = attr.name
+            sensor_state = attr.state
+            entity_attr = {
+                "unit_measure": unit_measur,
+                "name": sensor_name,
+                "state": sensor_state
+            }
+            return entity_attr
         return None
 
+    def _unlogged(self, entity):
+        # the logbook leaves out sensors with a unit and attribute changes
+        # like a light's brightness, with delta refresh the values
+        # find_entity_attr reads may be old
+        return (self.delta_refresh and
+                (entity.domain == 'light' or
+                 entity.unit_of_measurement is not None) and
+                not (self._mirror is not None and self._mirror.synced))
+
     def execute_service(self, domain, service, data = None):
         """Execute service at HAServer
 
@@ -136,18 +778,47 @@ class HomeAssistantClient(object):
           raises HTTPErrors if non-Ok status code)
         """
         if data is not None:
-            data = json.dumps(data)
-        if self.ssl:
-            r = post("{}/api/services/{}/{}".format(self.url, domain, service),
-                     headers=self.headers, data=data,
-                     verify=self.verify, timeout=TIMEOUT)
-        else:
-            r = post("{}/api/services/{}/{}".format(self.url, domain, service),
-                     headers=self.headers, data=data,
-                     timeout=TIMEOUT)
+            data = dumps(data)
+        r = self._request('post', 'services', '/api/services/{}/{}'.format(
+            domain, service), data=data)
+        # the service call most likely changed some state
+        self.invalidate_cache()
         r.raise_for_status()
         return r
 
+    def execute_service_multi(self, service, entity_ids, data=None):
+        """Execute service for many entities, with one call per domain
+
+        Calls for different domains are sent concurrently.
+        Returns the responses in order of the domains' first entity.
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
+        by_domain = OrderedDict()
+        for entity_id in entity_ids:
+            domain = entity_id.split('.')[0]
+            by_domain.setdefault(domain, []).append(entity_id)
+        calls = []
+        for domain, ids in by_domain.items():
+            call_data = dict(data or {})
+            call_data['entity_id'] = ids
+            calls.append((domain, service, call_data))
+        if len(calls) <= 1:
+            return [self.execute_service(*call) for call in calls]
+        executor = self._get_executor()
+        futures = [executor.submit(self.execute_service, *call)
+                   for call in calls]
+        return [future.result() for future in futures]
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.pool_size)
+            return self._executor
+
     def find_component(self, component):
         """Check if a component is loaded at the HA-Server
 
@@ -155,20 +826,33 @@ class HomeAssistantClient(object):
         (Subclasses of ConnectionError or RequestException,
           raises HTTPErrors if non-Ok status code)
         """
-        if self.ssl:
-            req = get("{}/api/components".format(self.url),
-                      headers=self.headers, verify=self.verify,
-                      timeout=TIMEOUT)
-        else:
-            req = get("%s/api/components" % self.url, headers=self.headers,
-                      timeout=TIMEOUT)
+        components = frozenset(self._fetch_components())
+        if self._components is not None and components != self._components:
+            # new components may understand what the old ones did not
+            self.invalidate_conversation_cache()
+        self._components = components
+        self._components_time = time.monotonic()
+        return component in components
+
+    def _fetch_components(self):
+        """Download the list of loaded components
 
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
+        req = self._request('get', 'components', '/api/components')
         req.raise_for_status()
-        return component in req.json()
+        return loads(req.content)
 
     def engage_conversation(self, utterance):
         """Engage the conversation component at the Home Assistant server
 
+        Utterances the server did not understand are remembered for a
+        while and answered without asking it again, unless a component
+        was loaded meanwhile.  Understood ones are always sent, the
+        server acts on them.
+
         Throws request Exceptions
         (Subclasses of ConnectionError or RequestException,
           raises HTTPErrors if non-Ok status code)
@@ -179,21 +863,42 @@ class HomeAssistantClient(object):
             { 'speech': textual answer,
               'extra_data': ...}
         """
+        key = ' '.join(utils.full_process(utterance).split())
+        answer = self._not_understood.get(key)
+        if answer is not None and self._components_stale():
+            self.find_component('conversation')
+            answer = self._not_understood.get(key)
+        if answer is not None:
+            self.metrics.inc('conversation_cache_total', result='hit')
+            return answer
+        self.metrics.inc('conversation_cache_total', result='miss')
+        answer = self._process_conversation(utterance)
+        if answer.get('speech') == NOT_UNDERSTOOD:
+            self._not_understood.put(key, answer)
+        return answer
+
+    def _components_stale(self):
+        if self._mirror is not None and self._mirror.synced:
+            return False
+        return (self._components_time is None or
+                time.monotonic() - self._components_time >
+                COMPONENT_CHECK_INTERVAL)
+
+    def _process_conversation(self, utterance):
+        """Send an utterance to the conversation component
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
         data = {
             "text": utterance
         }
-        if self.ssl:
-            r = post("{}/api/conversation/process".format(self.url),
-                     headers=self.headers,
-                     data=json.dumps(data),
-                     verify=self.verify,
-                     timeout=TIMEOUT
-                     )
-        else:
-            r = post("{}/api/conversation/process".format(self.url),
-                     headers=self.headers,
-                     data=json.dumps(data),
-                     timeout=TIMEOUT
-                     )
+        r = self._request('post', 'conversation',
+                          '/api/conversation/process', data=dumps(data))
         r.raise_for_status()
-        return r.json()['speech']['plain']
+        return loads(r.content)['speech']['plain']
+
+    def invalidate_conversation_cache(self):
+        """Forget which utterances the conversation did not understand"""
+        self._not_understood.clear()
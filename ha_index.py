@@ -0,0 +1,273 @@
+"""Precomputed index for fuzzy matching entity names"""
+from collections import defaultdict
+
+from fuzzywuzzy import fuzz, process, utils
+
+# rapidfuzz and numpy are optional, they only speed up scoring
+try:
+    import numpy as np
+    from rapidfuzz import fuzz as rapid_fuzz
+    from rapidfuzz.process import cdist
+except ImportError:
+    cdist = None
+
+__author__ = 'btotharye'
+
+# Domains with more entities than this are prefiltered by trigrams,
+# only the best candidates of the prefilter are scored
+MAX_CANDIDATES = 40
+
+# Score an attribute key needs to match a spoken attribute
+ATTRIBUTE_SCORE = 60
+
+# Which normalized names of an entry the prefilter looks at
+NAME = 1
+ENTITY_ID = 2
+
+# Words of names too common to tell that an entity is meant, short
+# words aren't dropped as such, names like 'TV' or 'AC' are just as short
+STOPWORDS = frozenset(['the', 'and', 'for', 'with', 'der', 'die', 'das',
+                       'und', 'von', 'mit', 'an', 'at', 'in', 'is', 'it',
+                       'me', 'my', 'of', 'on', 'to', 'up', 'am', 'im',
+                       'es', 'zu'])
+
+
+def normalize(name):
+    """Processes a name the way fuzzywuzzy's token_sort_ratio does
+
+    Lower case, punctuation and non ascii characters stripped and the
+    tokens sorted.  Plain ratios of normalized names are token sort ratios.
+    """
+    return ' '.join(sorted(utils.full_process(name, force_ascii=True).split()))
+
+
+def name_tokens(text):
+    """Words of a normalized text that may name an entity, singular"""
+    return {word[:-1] if len(word) > 3 and word.endswith('s') else word
+            for word in text.split()
+            if len(word) > 1 and word not in STOPWORDS}
+
+
+def trigrams(text):
+    text = ' {} '.format(text)
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class FuzzywuzzyScorer(object):
+    """Scores normalized names one pair at a time
+
+    Only the prefiltered candidates of an EntityIndex are scored.
+    """
+    batched = False
+
+    def ratio(self, query, choices):
+        return [fuzz.ratio(query, choice) for choice in choices]
+
+    def partial_ratio(self, query, choices):
+        return [fuzz.partial_ratio(query, choice) for choice in choices]
+
+
+class RapidfuzzScorer(object):
+    """Scores a query against every name of an EntityIndex in one call
+
+    Returns NumPy arrays of scores rounded like fuzzywuzzy's, so they
+    can be masked by domain and compared with the same thresholds.
+    Partial ratios are upper bounds of fuzzywuzzy's, EntityIndex rescores
+    the few best ones.
+    """
+    batched = True
+
+    def __init__(self):
+        if cdist is None:
+            raise ImportError('rapidfuzz and numpy are required for '
+                              'batched scoring')
+
+    def ratio(self, query, choices):
+        return self._cdist(query, choices, rapid_fuzz.ratio)
+
+    def partial_ratio(self, query, choices):
+        return self._cdist(query, choices, rapid_fuzz.partial_ratio)
+
+    @staticmethod
+    def _cdist(query, choices, scorer):
+        scores = cdist([query], choices, scorer=scorer, dtype=np.float64,
+                       workers=1)[0]
+        return np.rint(scores)
+
+
+def default_scorer():
+    """The batched scorer if rapidfuzz is installed, else fuzzywuzzy"""
+    if cdist is not None:
+        return RapidfuzzScorer()
+    return FuzzywuzzyScorer()
+
+
+class EntityIndex(object):
+    """Normalized names of all entities with a friendly name
+
+    Built once per state refresh.  Entries are kept in state order, so
+    ties are resolved the same way as scanning the state list.
+    """
+
+    def __init__(self, entities):
+        # (entity_id, normalized friendly_name, normalized entity_id)
+        self.entries = []
+        # normalized names by NAME / ENTITY_ID and domain of every entry,
+        # the domains as NumPy array once a batched scorer asks
+        self.names = {NAME: [], ENTITY_ID: []}
+        self.entry_domains = []
+        self._domain_array = None
+        # domain -> positions in entries
+        self.domains = defaultdict(list)
+        # domain -> trigram -> (position, NAME or ENTITY_ID)
+        self.grams = defaultdict(lambda: defaultdict(list))
+        # (position, NAME or ENTITY_ID) -> number of trigrams
+        self.sizes = {}
+        # words of all friendly names, see name_tokens
+        self.tokens = set()
+        for entity in entities:
+            name = entity.name
+            if name is None:
+                continue
+            entity_id = entity.entity_id
+            domain = entity.domain
+            pos = len(self.entries)
+            entry = (entity_id, normalize(name), normalize(entity_id))
+            self.entries.append(entry)
+            self.tokens.update(name_tokens(entry[NAME]))
+            self.names[NAME].append(entry[NAME])
+            self.names[ENTITY_ID].append(entry[ENTITY_ID])
+            self.entry_domains.append(domain)
+            self.domains[domain].append(pos)
+            grams = self.grams[domain]
+            for key in (NAME, ENTITY_ID):
+                key_grams = trigrams(entry[key])
+                self.sizes[(pos, key)] = len(key_grams)
+                for gram in key_grams:
+                    grams[gram].append((pos, key))
+
+    def best_match(self, query, domains, scorer, keys=(NAME, ENTITY_ID),
+                   partial=False, threshold=None):
+        """Best scoring entry for a normalized query
+
+        An entry scores the best of its names given by keys.  The score has
+        to be above threshold, ties go to the entry first in state order.
+        Returns (entry or None, score)
+        """
+        if isinstance(domains, str):
+            domains = [domains]
+        if scorer.batched:
+            return self._best_match_batched(query, domains, scorer, keys,
+                                            partial, threshold)
+        score_names = scorer.partial_ratio if partial else scorer.ratio
+        best_score = threshold
+        best_entry = None
+        for entry in self.candidates(query, domains, keys):
+            score = max(score_names(query, [entry[key] for key in keys]))
+            if best_score is None or score > best_score:
+                best_score = score
+                best_entry = entry
+        return best_entry, best_score
+
+    def _best_match_batched(self, query, domains, scorer, keys, partial,
+                            threshold):
+        if not self.entries:
+            return None, threshold
+        score_names = scorer.partial_ratio if partial else scorer.ratio
+        scores = None
+        for key in keys:
+            key_scores = score_names(query, self.names[key])
+            scores = (key_scores if scores is None else
+                      np.maximum(scores, key_scores))
+        if domains is not None:
+            if self._domain_array is None:
+                self._domain_array = np.array(self.entry_domains)
+            scores = np.where(np.isin(self._domain_array, domains),
+                              scores, -1)
+        if partial:
+            return self._refine_partial(query, scores, keys, threshold)
+        # argmax returns the first of equal scores
+        pos = int(np.argmax(scores))
+        score = int(scores[pos])
+        if score < 0 or (threshold is not None and score <= threshold):
+            return None, threshold
+        return self.entries[pos], score
+
+    def _refine_partial(self, query, bounds, keys, threshold):
+        # rapidfuzz finds the optimal partial alignment, fuzzywuzzy only
+        # tries a few, so rapidfuzz scores are upper bounds.  Rescoring in
+        # descending order until no bound can win gives fuzzywuzzy's result.
+        best_score = threshold
+        best_pos = None
+        for pos in np.argsort(-bounds, kind='stable'):
+            bound = bounds[pos]
+            if bound < 0 or best_score is not None and (
+                    bound < best_score or bound == best_score and
+                    (best_pos is None or pos > best_pos)):
+                break
+            score = max(fuzz.partial_ratio(query, self.entries[pos][key])
+                        for key in keys)
+            if (best_score is None or score > best_score or
+                    score == best_score and best_pos is not None and
+                    pos < best_pos):
+                best_score = score
+                best_pos = pos
+        if best_pos is None:
+            return None, threshold
+        return self.entries[best_pos], best_score
+
+    def candidates(self, query, domains=None, keys=(NAME, ENTITY_ID)):
+        """Entries worth scoring for a normalized query
+
+        Small domains are returned whole.  Large ones are cut down to the
+        entries whose names share the most trigrams with the query,
+        relative to the length of both.
+        """
+        if domains is None:
+            domains = list(self.domains)
+        elif isinstance(domains, str):
+            domains = [domains]
+        positions = []
+        for domain in domains:
+            positions.extend(self.domains.get(domain, ()))
+        if len(positions) <= MAX_CANDIDATES:
+            return [self.entries[pos] for pos in sorted(positions)]
+        query_grams = trigrams(query)
+        common = defaultdict(int)
+        for domain in domains:
+            grams = self.grams.get(domain)
+            if grams is None:
+                continue
+            for gram in query_grams:
+                for slot in grams.get(gram, ()):
+                    if slot[1] in keys:
+                        common[slot] += 1
+        similarity = defaultdict(float)
+        for slot, count in common.items():
+            dice = 2.0 * count / (len(query_grams) + self.sizes[slot])
+            if dice > similarity[slot[0]]:
+                similarity[slot[0]] = dice
+        best = sorted(similarity, key=similarity.get, reverse=True)
+        return [self.entries[pos] for pos in sorted(best[:MAX_CANDIDATES])]
+
+
+class AttributeIndex(object):
+    """Entities by the keys of their attributes
+
+    Built once per state refresh, so a spoken attribute is matched against
+    the few distinct keys instead of the keys of every entity.
+    """
+
+    def __init__(self, entities):
+        # attribute key -> entity_ids having it, in state order
+        self.keys = defaultdict(list)
+        for entity in entities:
+            for key in entity.attributes:
+                self.keys[key].append(entity.entity_id)
+
+    def best_key(self, attribute, threshold=ATTRIBUTE_SCORE):
+        """The key most like attribute, None if none scores threshold"""
+        candidate = process.extractOne(
+            attribute, list(self.keys), scorer=fuzz.partial_token_sort_ratio,
+            score_cutoff=threshold)
+        return candidate[0] if candidate else None
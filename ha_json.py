@@ -0,0 +1,42 @@
+"""JSON codec for the traffic with Home Assistant
+
+Uses orjson or ujson if installed, they parse a big state list several
+times faster than the json module, which is the fallback.  loads() takes
+bytes or str and raises ValueError on invalid JSON, dumps() returns UTF-8
+encoded bytes.
+"""
+import json
+
+# the fast libraries are optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+__author__ = 'btotharye'
+
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj, ensure_ascii=False).encode()
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False).encode()
+
+
+if orjson is not None:
+    NAME = 'orjson'
+    loads = orjson.loads
+    dumps = orjson.dumps
+elif ujson is not None:
+    NAME = 'ujson'
+    loads = ujson.loads
+    dumps = _ujson_dumps
+else:
+    NAME = 'json'
+    loads = json.loads
+    dumps = _stdlib_dumps
@@ -0,0 +1,159 @@
+"""Counters and histograms of the time spent talking to Home Assistant"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+import time
+
+__author__ = 'btotharye'
+
+PREFIX = 'homeassistant_'
+# upper bounds of the histogram buckets, seconds and bytes
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1024, 10240, 102400, 1048576, 10485760)
+
+# name -> (type, help) of every metric
+METRICS = {
+    'requests_total': (
+        'counter', 'Requests to Home Assistant by endpoint and status'),
+    'request_seconds': (
+        'histogram', 'Duration of requests to Home Assistant'),
+    'response_bytes': (
+        'histogram', 'Size of the responses of Home Assistant'),
+    'hedged_requests_total': (
+        'counter', 'Reads sent a second time as they took unusually long'),
+    'conversation_cache_total': (
+        'counter', 'Utterances answered from the cache of not understood '
+        'ones (hit) or not'),
+    'state_cache_total': (
+        'counter', 'Lookups served from the state cache (hit), by a '
+        'download of another thread (shared) or not (miss)'),
+    'index_build_seconds': (
+        'histogram', 'Time to build the name index of the states'),
+    'match_seconds': (
+        'histogram', 'Time to fuzzy match a name, without fetching'),
+}
+
+
+class Histogram(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # one more for values above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """(upper bound, observations up to it), the last bound is inf"""
+        total = 0
+        bounds = self.buckets + (float('inf'),)
+        result = []
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics(object):
+    """Thread-safe store of counters and histograms with labels
+
+    The names are those of METRICS.  snapshot() returns everything as
+    JSON-serializable dict, prometheus() in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # (name, sorted label items) -> value or Histogram
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=TIME_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the seconds spent in the with block"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def request(self, endpoint, status, seconds, size=None):
+        """Record a request, status is the HTTP status or the name of the
+        exception it failed with"""
+        self.inc('requests_total', endpoint=endpoint, status=str(status))
+        self.observe('request_seconds', seconds, endpoint=endpoint)
+        if size is not None:
+            self.observe('response_bytes', size, SIZE_BUCKETS,
+                         endpoint=endpoint)
+
+    def snapshot(self):
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels),
+                         'value': value}
+                        for (name, labels), value in self._counters.items()]
+            histograms = [{'name': name, 'labels': dict(labels),
+                           'count': h.count, 'sum': h.sum,
+                           'buckets': [[str(bound), count] for bound, count
+                                       in h.cumulative()]}
+                          for (name, labels), h in self._histograms.items()]
+        return {'counters': counters, 'histograms': histograms}
+
+    def prometheus(self):
+        with self._lock:
+            samples = {}
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append(
+                    (name, labels, value))
+            for (name, labels), h in self._histograms.items():
+                lines = samples.setdefault(name, [])
+                for bound, count in h.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append((name + '_bucket',
+                                  labels + (('le', le),), count))
+                lines.append((name + '_sum', labels, h.sum))
+                lines.append((name + '_count', labels, h.count))
+        out = []
+        for name in sorted(samples):
+            kind, text = METRICS.get(name, ('untyped', name))
+            out.append('# HELP {}{} {}'.format(PREFIX, name, text))
+            out.append('# TYPE {}{} {}'.format(PREFIX, name, kind))
+            for sample, labels, value in sorted(samples[name],
+                                                key=_sample_order):
+                out.append('{}{}{} {}'.format(
+                    PREFIX, sample, _labels(labels), value))
+        return '\n'.join(out) + '\n'
+
+
+def _sample_order(sample):
+    # series together, their buckets ascending, then _sum and _count
+    name, labels, _ = sample
+    series = tuple(label for label in labels if label[0] != 'le')
+    le = dict(labels).get('le')
+    bound = float('inf') if le in (None, '+Inf') else float(le)
+    return series, name.endswith('_count'), name.endswith('_sum'), bound
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels) + '}'
@@ -0,0 +1,64 @@
+"""Request timeouts adapting to the latency of each endpoint"""
+from collections import deque
+from threading import Lock
+
+__author__ = 'btotharye'
+
+# Timeout until enough requests of an endpoint were seen
+DEFAULT_TIMEOUT = 10
+# Latencies kept per endpoint, and needed before adapting
+WINDOW = 100
+MIN_SAMPLES = 10
+# The timeout is this many times the 99th percentile latency, but never
+# below MIN_TIMEOUT or above the endpoint's maximum, the default if not
+# listed here
+FACTOR = 4
+MIN_TIMEOUT = 2
+MAX_TIMEOUTS = {'states': 30}
+# Percentile after which a hedged second request is sent
+HEDGE_PERCENTILE = 95
+
+
+class AdaptiveTimeouts(object):
+    """Derives each endpoint's timeout from its recent latencies
+
+    A cheap lookup gets a short timeout on a fast server, a large state
+    download a longer one on a slow server.  Timed out requests count
+    with the timeout as latency, so a slow but alive server soon gets
+    timeouts long enough for it.  Only reads adapt: HA answers a service
+    call once the service finished, however long it usually takes, so
+    writes keep the default.
+    """
+
+    def __init__(self, default=DEFAULT_TIMEOUT):
+        self.default = default
+        self._latencies = {}
+        self._lock = Lock()
+
+    def observe(self, endpoint, seconds):
+        with self._lock:
+            latencies = self._latencies.get(endpoint)
+            if latencies is None:
+                latencies = self._latencies[endpoint] = deque(maxlen=WINDOW)
+            latencies.append(seconds)
+
+    def percentile(self, endpoint, p):
+        """Latency percentile, None before MIN_SAMPLES requests"""
+        with self._lock:
+            latencies = sorted(self._latencies.get(endpoint, ()))
+        if len(latencies) < MIN_SAMPLES:
+            return None
+        return latencies[min(len(latencies) - 1, len(latencies) * p // 100)]
+
+    def timeout(self, endpoint, method='get'):
+        if method.lower() != 'get':
+            return self.default
+        p99 = self.percentile(endpoint, 99)
+        if p99 is None:
+            return self.default
+        return min(MAX_TIMEOUTS.get(endpoint, self.default),
+                   max(MIN_TIMEOUT, FACTOR * p99))
+
+    def hedge_delay(self, endpoint):
+        """Seconds to wait before hedging, None while unknown"""
+        return self.percentile(endpoint, HEDGE_PERCENTILE)
@@ -0,0 +1,74 @@
+"""Spoken names of the units of measurement of sensors"""
+import logging
+
+__author__ = 'btotharye'
+LOGGER = logging.getLogger(__name__)
+
+# Units of Home Assistant's usual sensors, named like quantulum does
+UNIT_NAMES = {
+    '°C': 'degree Celsius',
+    '°F': 'degree Fahrenheit',
+    '%': 'percent',
+    'W': 'watt',
+    'kW': 'kilowatt',
+    'Wh': 'watt hour',
+    'kWh': 'kilowatt hour',
+    'V': 'volt',
+    'A': 'ampere',
+    'lx': 'lux',
+    'hPa': 'hectopascal',
+    'mbar': 'millibar',
+    'km/h': 'kilometre per hour',
+    'm/s': 'metre per second',
+    'mm': 'millimetre',
+    'ppm': 'parts per million',
+}
+
+
+class UnitNames(object):
+    """Looks up how to pronounce a unit_of_measurement
+
+    Units not in UNIT_NAMES are parsed by quantulum, if it is installed,
+    once per unit.  Loading quantulum takes a while, so load() is best
+    called in the background before the first sensor is read out.
+    """
+
+    def __init__(self):
+        # unit -> spoken name, the unit itself if it has none
+        self._names = dict(UNIT_NAMES)
+        # quantulum's parser, False until loaded and None if missing
+        self._parser = False
+
+    def load(self):
+        if self._parser is not False:
+            return
+        # this is fully optional
+        try:
+            from quantulum import parser
+        except ImportError:
+            parser = None
+        self._parser = parser
+
+    def name(self, unit):
+        if not unit:
+            return unit
+        name = self._names.get(unit)
+        if name is None:
+            name = self._names[unit] = self._parse(unit)
+        return name
+
+    def _parse(self, unit):
+        self.load()
+        if self._parser is None:
+            return unit
+        try:
+            quantities = self._parser.parse(u'1 {}'.format(unit))
+        except Exception as e:
+            LOGGER.debug('Could not parse unit {}: {}'.format(unit, e))
+            return unit
+        if len(quantities) > 0:
+            quantity = quantities[0]
+            if (quantity.unit.name != "dimensionless" and
+                    quantity.uncertainty <= 0.5):
+                return quantity.unit.name
+        return unit
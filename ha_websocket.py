@@ -0,0 +1,178 @@
+"""Live mirror of the Home Assistant state over the websocket API"""
+from threading import Event, Thread
+from urllib.parse import urlparse
+import logging
+import ssl
+import time
+
+try:
+    from websocket import WebSocketTimeoutException, create_connection
+except ImportError:
+    # the websocket mode is not available then
+    WebSocketTimeoutException = create_connection = None
+
+try:
+    from .ha_json import dumps, loads
+except ImportError:
+    from ha_json import dumps, loads
+
+__author__ = 'btotharye'
+LOGGER = logging.getLogger(__name__)
+
+# Timeout time for connecting and authenticating
+TIMEOUT = 10
+# Seconds to wait before reconnecting, doubled up to the maximum
+RECONNECT_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+# Seconds between pings, and to wait for the pong before the connection
+# counts as dead, e.g. after HA's host lost power without closing it
+PING_INTERVAL = 30
+PONG_TIMEOUT = 10
+
+SUBSCRIBE_ID = 1
+GET_STATES_ID = 2
+COMPONENTS_ID = 3
+# ids of the pings count up from here, HA wants increasing ids
+FIRST_PING_ID = 4
+
+
+class HomeAssistantWebsocket(object):
+    """Keeps the state cache of a HomeAssistantClient up to date
+
+    Opens /api/websocket, authenticates, subscribes to state_changed
+    events and loads the full state once.  Every event is applied to the
+    client afterwards, so lookups are answered without HTTP requests.
+    A dropped connection is reopened and the state loaded again, as is
+    one that stops answering pings.
+    Newly loaded components, and reconnecting after a restart of HA,
+    clear the client's cache of not understood utterances.
+    """
+
+    def __init__(self, client, password=None):
+        if create_connection is None:
+            raise ImportError('websocket-client is required for the '
+                              'websocket mode')
+        self.client = client
+        self.password = password
+        parts = urlparse(client.url)
+        scheme = 'wss' if parts.scheme == 'https' else 'ws'
+        self.url = '{}://{}{}/api/websocket'.format(
+            scheme, parts.netloc, parts.path.rstrip('/'))
+        self.synced = False
+        self._ws = None
+        self._stopping = Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._run, daemon=True,
+                                  name='HomeAssistantWebsocket')
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self.synced = False
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+        if self._thread is not None:
+            self._thread.join(TIMEOUT)
+            self._thread = None
+
+    def _run(self):
+        delay = RECONNECT_DELAY
+        while not self._stopping.is_set():
+            try:
+                self._connect()
+                delay = RECONNECT_DELAY
+                self._listen()
+            except Exception as e:
+                if not self._stopping.is_set():
+                    LOGGER.warning('Home Assistant websocket dropped: '
+                                   '{}'.format(e))
+            finally:
+                self.synced = False
+                if self._ws is not None:
+                    try:
+                        self._ws.close()
+                    except Exception:
+                        pass
+                    self._ws = None
+            self._stopping.wait(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def _connect(self):
+        sslopt = None
+        if not self.client.verify:
+            sslopt = {'cert_reqs': ssl.CERT_NONE}
+        self._ws = create_connection(self.url, timeout=TIMEOUT,
+                                     sslopt=sslopt)
+        msg = self._recv()
+        if msg.get('type') == 'auth_required':
+            self._send({'type': 'auth', 'api_password': self.password})
+            msg = self._recv()
+        if msg.get('type') != 'auth_ok':
+            raise ConnectionError('Websocket authentication failed: '
+                                  '{}'.format(msg.get('message')))
+        # HA may have restarted with other intents meanwhile
+        self.client.invalidate_conversation_cache()
+        # subscribe before loading the state so no change gets lost between
+        self._send({'id': SUBSCRIBE_ID, 'type': 'subscribe_events',
+                    'event_type': 'state_changed'})
+        self._send({'id': GET_STATES_ID, 'type': 'get_states'})
+        self._send({'id': COMPONENTS_ID, 'type': 'subscribe_events',
+                    'event_type': 'component_loaded'})
+        # wake up in time to notice a missing pong
+        self._ws.settimeout(PONG_TIMEOUT)
+
+    def _listen(self):
+        ping_id = FIRST_PING_ID
+        last_ping = time.monotonic()
+        # send time of the ping waiting for its pong
+        pending = None
+        while not self._stopping.is_set():
+            try:
+                msg = self._recv()
+            except WebSocketTimeoutException:
+                msg = None
+            if msg is not None and msg.get('type') == 'pong':
+                pending = None
+            elif msg is not None:
+                self._handle(msg)
+            now = time.monotonic()
+            if pending is not None:
+                if now - pending > PONG_TIMEOUT:
+                    raise ConnectionError('Home Assistant stopped answering '
+                                          'pings')
+            elif now - last_ping >= PING_INTERVAL:
+                self._send({'id': ping_id, 'type': 'ping'})
+                ping_id += 1
+                pending = last_ping = now
+
+    def _handle(self, msg):
+        if msg.get('type') == 'result':
+            if not msg.get('success'):
+                raise ConnectionError('Websocket command failed: '
+                                      '{}'.format(msg.get('error')))
+            if msg.get('id') == GET_STATES_ID:
+                self.client._apply_snapshot(msg['result'])
+                self.synced = True
+        elif msg.get('type') == 'event' and msg.get('id') == COMPONENTS_ID:
+            self.client.invalidate_conversation_cache()
+        elif msg.get('type') == 'event' and self.synced:
+            # events seen before the snapshot are already part of it
+            data = msg['event']['data']
+            self.client._apply_state_change(data['entity_id'],
+                                            data.get('new_state'))
+
+    def _send(self, msg):
+        self._ws.send(dumps(msg))
+
+    def _recv(self):
+        raw = self._ws.recv()
+        if not raw:
+            raise ConnectionError('Websocket closed by Home Assistant')
+        return loads(raw)
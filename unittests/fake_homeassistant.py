@@ -0,0 +1,582 @@
+"""Stand-in for a Home Assistant server, for load and latency tests
+
+Serves the REST API the skill uses and the websocket API from a list of
+state objects.  Latency, failing requests and state churn can be
+injected:
+
+    python unittests/fake_homeassistant.py --entities 5000 --latency 0.05 \\
+        --error 503=0.05 --error timeout=0.01 --churn 10
+
+or in a test:
+
+    server = FakeHomeAssistant(states, errors={503: 0.1}).start()
+    client = HomeAssistantClient(server.url, server.password)
+    ...
+    server.stop()
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Event, Lock, Thread
+from urllib.parse import unquote
+import argparse
+import base64
+import copy
+import datetime
+import gzip
+import hashlib
+import json
+import random
+import socket
+import struct
+import time
+
+__author__ = 'btotharye'
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+# websocket frame opcodes
+TEXT = 0x1
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+
+ROOMS = ['Kitchen', 'Living Room', 'Bedroom', 'Guest Room', 'Office',
+         'Bathroom', 'Hallway', 'Garage', 'Basement', 'Attic', 'Garden',
+         'Porch', 'Dining Room', 'Nursery', 'Laundry', 'Cellar']
+# domain -> device names and attributes of its entities
+DEVICES = {
+    'light': (['Ceiling Light', 'Lamp', 'Spots', 'Strip', 'Chandelier',
+               'Reading Light'],
+              lambda r: {'brightness': r.randint(0, 255),
+                         'max_mireds': 500, 'min_mireds': 153,
+                         'supported_features': 151}),
+    'switch': (['Outlet', 'Fan', 'Heater', 'Coffee Maker', 'Pump'],
+               lambda r: {}),
+    'sensor': (['Temperature', 'Humidity', 'Power', 'Battery',
+                'Illuminance'],
+               lambda r: {'unit_of_measurement': r.choice(['°C', '%', 'W',
+                                                           'lx']),
+                          'device_class': 'temperature'}),
+    'binary_sensor': (['Motion', 'Door', 'Window', 'Smoke'],
+                      lambda r: {'device_class': 'motion'}),
+    'climate': (['Thermostat', 'Radiator'],
+                lambda r: {'current_temperature': r.randint(15, 25),
+                           'temperature': 21, 'operation_mode': 'heat',
+                           'operation_list': ['heat', 'cool', 'off']}),
+    'media_player': (['Speaker', 'TV', 'Receiver'],
+                     lambda r: {'volume_level': 0.4, 'is_volume_muted':
+                                False, 'source': 'Radio'}),
+    'input_boolean': (['Guest Mode', 'Vacation Mode', 'Night Mode'],
+                      lambda r: {}),
+    'automation': (['Wake Up', 'Lights Out', 'Presence'],
+                   lambda r: {'last_triggered': None}),
+    'device_tracker': (['Phone', 'Tablet', 'Watch'],
+                       lambda r: {'source_type': 'router'}),
+}
+# domain -> states its entities switch between, numbers if missing
+STATES = {'light': ['on', 'off'], 'switch': ['on', 'off'],
+          'binary_sensor': ['on', 'off'], 'climate': ['heat', 'cool'],
+          'media_player': ['playing', 'paused', 'off'],
+          'input_boolean': ['on', 'off'], 'automation': ['on', 'off'],
+          'device_tracker': ['home', 'not_home']}
+# Responses above this many bytes are compressed if the client accepts gzip
+GZIP_MIN_SIZE = 1024
+# service -> state it sets
+SERVICE_STATES = {'turn_on': 'on', 'turn_off': 'off',
+                  'media_play': 'playing', 'media_pause': 'paused'}
+
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def generate_states(size, seed=0):
+    """State list of size entities with names like 'Kitchen Lamp 2'
+
+    Includes a group per room, the same seed gives the same states.
+    """
+    r = random.Random(seed)
+    states = []
+    taken = set()
+    domains = sorted(DEVICES)
+    while len(states) < size - len(ROOMS):
+        domain = r.choice(domains)
+        devices, attributes = DEVICES[domain]
+        room = r.choice(ROOMS)
+        name = '{} {}'.format(room, r.choice(devices))
+        number = 1
+        while name in taken:
+            number += 1
+            name = '{} {} {}'.format(room, r.choice(devices), number)
+        taken.add(name)
+        attrs = attributes(r)
+        attrs['friendly_name'] = name
+        choices = STATES.get(domain)
+        states.append({
+            'entity_id': '{}.{}'.format(
+                domain, name.lower().replace(' ', '_')),
+            'state': r.choice(choices) if choices else str(r.randint(0, 100)),
+            'attributes': attrs,
+            'last_changed': '2018-06-01T12:00:00.000000+00:00',
+            'last_updated': '2018-06-01T12:00:00.000000+00:00',
+            'context': {'id': '{:032x}'.format(r.getrandbits(128)),
+                        'user_id': None}})
+    for room in ROOMS[:size]:
+        members = [s['entity_id'] for s in states
+                   if s['attributes']['friendly_name'].startswith(room)]
+        states.append({
+            'entity_id': 'group.{}'.format(room.lower().replace(' ', '_')),
+            'state': 'on',
+            'attributes': {'friendly_name': room, 'entity_id': members}})
+    return states
+
+
+class FakeHomeAssistantHandler(BaseHTTPRequestHandler):
+    # keep-alive like aiohttp, and TCP_NODELAY so a response whose
+    # headers and body are sent apart is not held back by Nagle
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path == '/api/websocket':
+            return self._websocket()
+        if not self._inject():
+            return
+        if self.path == '/api/':
+            self._send_json(200, {'message': 'API running.'})
+        elif self.path == '/api/states':
+            if self._accepts_gzip():
+                self._send(200, self.server.payload(compressed=True),
+                           encoding='gzip')
+            else:
+                self._send(200, self.server.payload())
+        elif self.path.startswith('/api/states/'):
+            state = self.server.get_state(self.path[len('/api/states/'):])
+            if state is None:
+                self._send_json(404, {'message': 'Entity not found.'})
+            else:
+                self._send_json(200, state)
+        elif self.path == '/api/components':
+            self._send_json(200, self.server.components)
+        elif self.path.startswith('/api/logbook/'):
+            since = unquote(self.path[len('/api/logbook/'):])
+            self._send_json(200, self.server.logbook_since(since))
+        else:
+            self._send_json(404, {'message': 'Not found.'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        if not self._inject():
+            return
+        try:
+            data = json.loads(body.decode()) if body else {}
+        except ValueError:
+            return self._send_json(400, {'message': 'Invalid JSON.'})
+        if self.path == '/api/conversation/process':
+            self._send_json(200, {'speech': {'plain': {
+                'speech': self.server.conversation(data.get('text', '')),
+                'extra_data': None}}})
+        elif self.path.startswith('/api/services/'):
+            parts = self.path[len('/api/services/'):].split('/')
+            if len(parts) != 2:
+                return self._send_json(404, {'message': 'Not found.'})
+            self._send_json(200, self.server.call_service(
+                parts[0], parts[1], data))
+        else:
+            self._send_json(404, {'message': 'Not found.'})
+
+    def _authorized(self, password):
+        return (self.server.password is None or
+                password == self.server.password)
+
+    def _inject(self):
+        # delays the request and fails it as configured,
+        # returns False if the request must not be answered
+        server = self.server
+        delay = server.latency + server.random.uniform(0, server.jitter)
+        if delay:
+            time.sleep(delay)
+        if not self._authorized(self.headers.get('x-ha-access')):
+            self._send_json(401, {'message': 'Unauthorized'})
+            return False
+        error = server.pick_error()
+        if error == 'timeout':
+            # answer nothing until the client gave up
+            time.sleep(server.hang)
+            self.close_connection = True
+            return False
+        if error is not None:
+            self._send_json(error, {'message': 'Injected error'})
+            return False
+        return True
+
+    def _accepts_gzip(self):
+        return 'gzip' in self.headers.get('Accept-Encoding', '')
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode()
+        if len(body) > GZIP_MIN_SIZE and self._accepts_gzip():
+            self._send(status, gzip.compress(body, 1), encoding='gzip')
+        else:
+            self._send(status, body)
+
+    def _send(self, status, body, encoding=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+    # websocket API
+
+    def _websocket(self):
+        key = self.headers.get('Sec-WebSocket-Key')
+        if self.headers.get('Upgrade', '').lower() != 'websocket' or not key:
+            return self._send_json(400, {'message': 'Expected websocket'})
+        accept = base64.b64encode(hashlib.sha1(
+            (key + WEBSOCKET_GUID).encode()).digest()).decode()
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.close_connection = True
+        self._write_lock = Lock()
+        self.server.add_websocket(self)
+        try:
+            self._websocket_session()
+        except (ConnectionError, OSError, ValueError):
+            pass
+        finally:
+            self.server.remove_websocket(self)
+
+    def _websocket_session(self):
+        self.subscribed = set()
+        self.send_message({'type': 'auth_required'})
+        msg = self._recv_message()
+        if msg is None:
+            return
+        if not self._authorized(msg.get('api_password') or
+                                msg.get('access_token')):
+            self.send_message({'type': 'auth_invalid',
+                               'message': 'Invalid password'})
+            return
+        self.send_message({'type': 'auth_ok'})
+        while True:
+            msg = self._recv_message()
+            if msg is None:
+                return
+            self._handle_command(msg)
+
+    def _handle_command(self, msg):
+        kind = msg.get('type')
+        result = None
+        if kind == 'subscribe_events':
+            self.subscribed.add((msg['id'], msg.get('event_type')))
+        elif kind == 'get_states':
+            result = self.server.states()
+        elif kind == 'call_service':
+            self.server.call_service(msg['domain'], msg['service'],
+                                     msg.get('service_data', {}))
+        elif kind == 'ping':
+            return self.send_message({'id': msg.get('id'), 'type': 'pong'})
+        else:
+            return self.send_message({
+                'id': msg.get('id'), 'type': 'result', 'success': False,
+                'error': {'code': 'unknown_command',
+                          'message': 'Unknown command.'}})
+        self.send_message({'id': msg.get('id'), 'type': 'result',
+                           'success': True, 'result': result})
+
+    def send_event(self, event):
+        for sub_id, event_type in list(self.subscribed):
+            if event_type in (None, event['event_type']):
+                self.send_message({'id': sub_id, 'type': 'event',
+                                   'event': event})
+
+    def send_message(self, msg):
+        self._send_frame(TEXT, json.dumps(msg).encode())
+
+    def _send_frame(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            head = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 1 << 16:
+            head = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            head = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        with self._write_lock:
+            self.wfile.write(head + payload)
+            self.wfile.flush()
+
+    def _recv_message(self):
+        # None once the client closed the connection
+        while True:
+            opcode, payload = self._recv_frame()
+            if opcode == TEXT:
+                return json.loads(payload.decode())
+            if opcode == PING:
+                self._send_frame(PONG, payload)
+            elif opcode == CLOSE:
+                self._send_frame(CLOSE, payload[:2])
+                return None
+
+    def _recv_frame(self):
+        first, second = self._read(2)
+        length = second & 0x7f
+        if length == 126:
+            length, = struct.unpack('!H', self._read(2))
+        elif length == 127:
+            length, = struct.unpack('!Q', self._read(8))
+        mask = self._read(4) if second & 0x80 else None
+        payload = self._read(length)
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return first & 0x0f, payload
+
+    def _read(self, size):
+        data = self.rfile.read(size)
+        if len(data) < size:
+            raise ConnectionError('Websocket closed')
+        return data
+
+
+class FakeHomeAssistant(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server acting as Home Assistant on localhost
+
+    states are served as given.  Every REST request waits latency plus up
+    to jitter seconds.  errors maps an HTTP status or 'timeout' to the
+    share of requests failing with it, a timeout answers nothing for hang
+    seconds.  A wrong password is refused with 401.  churn is the number
+    of random state changes per second, sent to websocket subscribers like
+    the changes of service calls.
+    """
+    daemon_threads = True
+
+    def __init__(self, states, password='password', port=0, latency=0,
+                 jitter=0, errors=None, hang=15, churn=0,
+                 components=('conversation', 'group', 'light', 'sensor'),
+                 seed=None):
+        super().__init__(('127.0.0.1', port), FakeHomeAssistantHandler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server_port)
+        self.password = password
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = dict(errors or {})
+        self.hang = hang
+        self.churn = churn
+        self.components = list(components)
+        self.random = random.Random(seed)
+        # service calls received, as (domain, service, data)
+        self.calls = []
+        # logbook entries of state changes, oldest first
+        self.logbook = []
+        self._states = {s['entity_id']: copy.deepcopy(s) for s in states}
+        # encoded state list, plain and compressed
+        self._payload = {}
+        self._lock = Lock()
+        self._websockets = []
+        self._stopping = Event()
+
+    def start(self):
+        Thread(target=self.serve_forever, daemon=True,
+               name='FakeHomeAssistant').start()
+        Thread(target=self._churn, daemon=True,
+               name='FakeHomeAssistantChurn').start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        self.shutdown()
+        with self._lock:
+            websockets = list(self._websockets)
+        for handler in websockets:
+            try:
+                handler.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.server_close()
+
+    def pick_error(self):
+        # the injected error of a request, None for most
+        roll = self.random.random()
+        for error, rate in self.errors.items():
+            if roll < rate:
+                return error
+            roll -= rate
+        return None
+
+    def states(self):
+        with self._lock:
+            return list(self._states.values())
+
+    def get_state(self, entity_id):
+        with self._lock:
+            return self._states.get(entity_id)
+
+    def payload(self, compressed=False):
+        # the encoded state list, encoded again after changes only
+        with self._lock:
+            if compressed not in self._payload:
+                body = json.dumps(list(self._states.values())).encode()
+                if compressed:
+                    body = gzip.compress(body, 1)
+                self._payload[compressed] = body
+            return self._payload[compressed]
+
+    def set_state(self, entity_id, state, attributes=None):
+        """Change an entity like HA would, None removes it"""
+        with self._lock:
+            old_state = self._states.get(entity_id)
+            if state is None:
+                new_state = None
+                self._states.pop(entity_id, None)
+            else:
+                if attributes is None:
+                    attributes = old_state['attributes'] if old_state else {}
+                changed = now()
+                new_state = {
+                    'entity_id': entity_id, 'state': state,
+                    'attributes': attributes,
+                    'last_changed': changed, 'last_updated': changed,
+                    'context': {'id': '{:032x}'.format(
+                        self.random.getrandbits(128)), 'user_id': None}}
+                self._states[entity_id] = new_state
+                if self._logged(old_state, new_state):
+                    self.logbook.append({
+                        'when': changed, 'name': attributes.get(
+                            'friendly_name', entity_id),
+                        'state': state, 'entity_id': entity_id,
+                        'domain': entity_id.split('.')[0]})
+            self._payload = {}
+            websockets = list(self._websockets)
+        event = {'event_type': 'state_changed', 'origin': 'LOCAL',
+                 'time_fired': now(),
+                 'data': {'entity_id': entity_id, 'old_state': old_state,
+                          'new_state': new_state}}
+        for handler in websockets:
+            try:
+                handler.send_event(event)
+            except OSError:
+                pass
+        return new_state
+
+    @staticmethod
+    def _logged(old_state, new_state):
+        # like HA, only changes of the state, not of sensors with a unit
+        return ((old_state is None or
+                 old_state['state'] != new_state['state']) and
+                'unit_of_measurement' not in new_state['attributes'])
+
+    def logbook_since(self, since):
+        with self._lock:
+            return [e for e in self.logbook if e['when'] >= since]
+
+    def restart(self):
+        """Log a restart, as HA does on start"""
+        with self._lock:
+            self.logbook.append({'when': now(), 'name': 'Home Assistant',
+                                 'message': 'started',
+                                 'domain': 'homeassistant'})
+
+    def call_service(self, domain, service, data):
+        """Record a service call and apply it to the states, returns the
+        changed states"""
+        self.calls.append((domain, service, data))
+        entity_ids = data.get('entity_id', [])
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+        changed = []
+        for entity_id in entity_ids:
+            old_state = self.get_state(entity_id)
+            if old_state is None:
+                continue
+            state = SERVICE_STATES.get(service)
+            if service == 'toggle':
+                state = 'off' if old_state['state'] == 'on' else 'on'
+            attributes = dict(old_state['attributes'])
+            for key, value in data.items():
+                if key != 'entity_id':
+                    attributes[key] = value
+            changed.append(self.set_state(
+                entity_id, state or old_state['state'], attributes))
+        return changed
+
+    def conversation(self, text):
+        return 'Sorry, I didn\'t understand that'
+
+    def add_websocket(self, handler):
+        with self._lock:
+            self._websockets.append(handler)
+
+    def remove_websocket(self, handler):
+        with self._lock:
+            if handler in self._websockets:
+                self._websockets.remove(handler)
+
+    def _churn(self):
+        # churn may be changed while running, 0 pauses it
+        while not self._stopping.wait(1.0 / self.churn if self.churn else 1):
+            with self._lock:
+                if not self.churn or not self._states:
+                    continue
+                entity_id = self.random.choice(list(self._states))
+            domain = entity_id.split('.')[0]
+            if domain == 'group':
+                continue
+            choices = STATES.get(domain)
+            state = (self.random.choice(choices) if choices else
+                     str(self.random.randint(0, 100)))
+            self.set_state(entity_id, state)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Fake Home Assistant server for load tests')
+    parser.add_argument('--port', type=int, default=8123)
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--fixture',
+                        help='JSON file of states, like /api/states returns')
+    parser.add_argument('--entities', type=int, default=1000,
+                        help='number of generated states without fixture')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds every request is delayed')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='up to this many seconds of added delay')
+    parser.add_argument('--error', action='append', default=[],
+                        metavar='STATUS=RATE',
+                        help='share of requests failing with an HTTP '
+                             'status or "timeout", e.g. 503=0.05')
+    parser.add_argument('--churn', type=float, default=0,
+                        help='random state changes per second')
+    args = parser.parse_args()
+
+    if args.fixture:
+        with open(args.fixture) as f:
+            states = json.load(f)
+    else:
+        states = generate_states(args.entities)
+    errors = {}
+    for error in args.error:
+        status, rate = error.split('=')
+        errors[status if status == 'timeout' else int(status)] = float(rate)
+    server = FakeHomeAssistant(states, password=args.password,
+                               port=args.port, latency=args.latency,
+                               jitter=args.jitter, errors=errors,
+                               churn=args.churn)
+    print('Serving {} entities at {}'.format(len(states), server.url))
+    server.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,28 @@ import sys
 sys.path.append('../')
 for p in sys.path:
     print(p)
-from ha_client import HomeAssistantClient
+from fuzzywuzzy import fuzz
+from ha_async import SyncHomeAssistantClient, aiohttp
+from ha_client import (Entity, HomeAssistantClient, ServiceDispatcher,
+                       SingleFlight, iter_states)
+from ha_circuit import CircuitOpenError
+from ha_metrics import Metrics
+from ha_timeouts import MIN_SAMPLES, MIN_TIMEOUT, AdaptiveTimeouts
+from ha_units import UnitNames
+from ha_websocket import WebSocketTimeoutException
+import ha_json
+from ha_index import (EntityIndex, FuzzywuzzyScorer, MAX_CANDIDATES,
+                      RapidfuzzScorer, cdist, normalize)
+from fake_homeassistant import FakeHomeAssistant, generate_states
+from requests import Response
+from requests.exceptions import ConnectionError, HTTPError, SSLError, Timeout
+import functools
+import importlib.util
+import json
+import os
+import queue
+import threading
+import time
 import unittest
 from unittest import mock
 
@@ -138,6 +159,892 @@ class TestHaClient(TestCase):
                     self.assertTrue(True)
 
 
+states = [json_data,
+          {'attributes': {'friendly_name': 'Outside Temperature',
+                          'unit_of_measurement': '°C'},
+           'entity_id': 'sensor.outside_temperature',
+           'state': '21.5'}]
+
+
+def response(data, status_code=200):
+    r = Response()
+    r.status_code = status_code
+    r._content = json.dumps(data).encode()
+    r._content_consumed = True
+    r.raw = mock.MagicMock()
+    return r
+
+
+class TestHaClientCache(TestCase):
+
+    @mock.patch('requests.Session.get')
+    def test_state_cached_between_lookups(self, mock_get):
+        mock_get.return_value = response(states)
+        ha = HomeAssistantClient('http://192.168.0.1:8123', 'password')
+        entity = ha.find_entity('kitchen lights', ['light'])
+        attr = ha.find_entity_attr(entity['id'])
+        self.assertEqual(attr['name'], 'Kitchen Lights')
+        self.assertEqual(mock_get.call_count, 1)
+
+    @mock.patch('requests.Session.post')
+    @mock.patch('requests.Session.get')
+    def test_service_call_invalidates_cache(self, mock_get, mock_post):
+        mock_get.return_value = response(states)
+        ha = HomeAssistantClient('http://192.168.0.1:8123', 'password')
+        ha.find_entity('kitchen lights', ['light'])
+        ha.execute_service('light', 'turn_on',
+                           {'entity_id': 'light.kitchen_lights'})
+        ha.find_entity('kitchen lights', ['light'])
+        self.assertEqual(mock_get.call_count, 2)
+
+    @mock.patch('requests.Session.get')
+    def test_attr_of_known_entity_fetched_alone(self, mock_get):
+        mock_get.return_value = response(states[1])
+        ha = HomeAssistantClient('http://192.168.0.1:8123', 'password')
+        attr = ha.find_entity_attr('sensor.outside_temperature')
+        self.assertEqual(attr['unit_measure'], '°C')
+        mock_get.assert_called_once_with(
+            'http://192.168.0.1:8123/api/states/sensor.outside_temperature',
+            timeout=10)
+
+    @mock.patch('requests.Session.get')
+    def test_streamed_lookup_without_cache(self, mock_get):
+        mock_get.return_value = response(states)
+        ha = HomeAssistantClient('http://192.168.0.1:8123', 'password',
+                                 cache_ttl=0)
+        self.assertEqual(ha.find_entity('outside temperature', ['sensor']),
+                         {'id': 'sensor.outside_temperature',
+                          'dev_name': 'Outside Temperature',
+                          'state': '21.5', 'best_score': 100})
+        self.assertEqual(ha._states, {})
+
+    @mock.patch('requests.Session.get')
+    def test_streamed_entity_loads_attributes_lazily(self, mock_get):
+        mock_get.return_value = response(states)
+        ha = HomeAssistantClient('http://192.168.0.1:8123', 'password',
+                                 cache_ttl=0)
+        found, _ = ha._get_index(['sensor'])
+        entity = found['sensor.outside_temperature']
+        self.assertEqual(entity.unit_of_measurement, '°C')
+        self.assertEqual(mock_get.call_count, 1)
+        mock_get.return_value = response(states[1])
+        self.assertEqual(entity.attributes, states[1]['attributes'])
+        self.assertEqual(mock_get.call_count, 2)
+
+    @mock.patch('requests.Session.get')
+    def test_prewarm_loads_state_and_index(self, mock_get):
+        mock_get.return_value = response(states)
+        ha = HomeAssistantClient('http://192.168.0.1:8123', 'password')
+        ha.prewarm()
+        self.assertIsNotNone(ha._index)
+        ha.find_entity('kitchen lights', ['light'])
+        self.assertEqual(mock_get.call_count, 1)
+        uncached = HomeAssistantClient('http://192.168.0.1:8123',
+                                       'password', cache_ttl=0)
+        uncached.prewarm()
+        # only the words of the names are kept, for mentions_entity
+        self.assertIsNone(uncached._index)
+        self.assertFalse(uncached.mentions_entity('what time is it'))
+        self.assertTrue(uncached.mentions_entity('outside temperature'))
+
+    @mock.patch('requests.Session.get')
+    def test_mentions_entity(self, mock_get):
+        tv = {'entity_id': 'media_player.tv', 'state': 'off',
+              'attributes': {'friendly_name': 'TV'}}
+        mock_get.return_value = response(states + [tv])
+        ha = HomeAssistantClient('http://192.168.0.1:8123', 'password')
+        self.assertTrue(ha.mentions_entity('what time is it'))
+        ha.prewarm()
+        self.assertTrue(ha.mentions_entity('Dim the Kitchen Lights'))
+        self.assertTrue(ha.mentions_entity('turn on the tv'))
+        self.assertFalse(ha.mentions_entity('what time is it'))
+        ha.invalidate_cache()
+        self.assertFalse(ha.mentions_entity('tell me a joke'))
+        self.assertEqual(mock_get.call_count, 1)
+
+    @mock.patch('requests.Session.get')
+    def test_find_attributes(self, mock_get):
+        mock_get.return_value = response(states)
+        ha = HomeAssistantClient('http://192.168.0.1:8123', 'password')
+        found = ha.find_attributes('unit')
+        self.assertEqual([(e.entity_id, k, v) for e, k, v in found],
+                         [('sensor.outside_temperature',
+                           'unit_of_measurement', '°C')])
+        self.assertEqual(len(ha.find_attributes('friendly name')), 2)
+        self.assertEqual(len(ha.find_attributes('friendly name', limit=1)), 1)
+        self.assertEqual(ha.find_attributes('xyzzy'), [])
+        lights = ha.find_entities(name='kitchen lights')
+        found = ha.find_attributes('mireds max', lights)
+        self.assertEqual([(k, v) for _, k, v in found],
+                         [('max_mireds', 500)])
+        ha._apply_state_change('sensor.outside_temperature', {
+            'attributes': {'battery_level': 80},
+            'entity_id': 'sensor.outside_temperature', 'state': '20'})
+        found = ha.find_attributes('battery')
+        self.assertEqual([v for _, _, v in found], [80])
+        self.assertEqual(mock_get.call_count, 1)
+
+    def test_concurrent_lookups_share_one_download(self):
+        ha = HomeAssistantClient('http://192.168.0.1:8123', 'password')
+
+        def slow_fetch():
+            time.sleep(0.2)
+            return states
+        ha._fetch_state = mock.Mock(side_effect=slow_fetch)
+        threads = [threading.Thread(target=ha.find_entity,
+                                    args=('kitchen', ['light']))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(ha._fetch_state.call_count, 1)
+
+    def test_single_flight_shares_errors(self):
+        flights = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        errors = []
+
+        def fail():
+            started.set()
+            release.wait()
+            raise Timeout('slow')
+
+        def call():
+            try:
+                flights.do('states', fail)
+            except Timeout as e:
+                errors.append(e)
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait()
+        follower = threading.Thread(target=call)
+        follower.start()
+        time.sleep(0.05)
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(len(errors), 2)
+        self.assertIs(errors[0], errors[1])
+        self.assertEqual(flights.do('states', lambda: 1), (1, False))
+
+    @mock.patch('requests.Session.get')
+    def test_cache_disabled(self, mock_get):
+        mock_get.return_value = response(states)
+        ha = HomeAssistantClient('http://192.168.0.1:8123', 'password',
+                                 cache_ttl=0)
+        ha.find_entities(domain='light')
+        ha.find_entities(domain='light')
+        self.assertEqual(mock_get.call_count, 2)
+
+
+group_states = states + [
+    {'attributes': {'friendly_name': 'Bedroom Light'},
+     'entity_id': 'light.bedroom', 'state': 'on'},
+    {'attributes': {'friendly_name': 'Kitchen Fan'},
+     'entity_id': 'switch.kitchen_fan', 'state': 'on'},
+    {'attributes': {'friendly_name': 'Kitchen',
+                    'entity_id': ['light.kitchen_lights', 'group.fans']},
+     'entity_id': 'group.kitchen', 'state': 'on'},
+    {'attributes': {'friendly_name': 'Fans',
+                    'entity_id': ['switch.kitchen_fan', 'group.kitchen']},
+     'entity_id': 'group.fans', 'state': 'on'}]
+
+
+class TestIterStates(TestCase):
+
+    def test_chunked_decode_with_domain_filter(self):
+        tricky = {'attributes': {'friendly_name': 'Quote " and { brace }',
+                                 'unit_of_measurement': '°C',
+                                 'icon': 'mdi:thermometer'},
+                  'entity_id': 'sensor.tricky', 'state': '\\'}
+        raw = json.dumps(states + [tricky], ensure_ascii=False).encode()
+        for size in (1, 7, len(raw)):
+            chunks = [raw[i:i + size] for i in range(0, len(raw), size)]
+            self.assertEqual(list(iter_states(chunks)), states + [tricky])
+            self.assertEqual(
+                list(iter_states(chunks, ['sensor'], ['friendly_name'])),
+                [{'attributes': {'friendly_name': 'Outside Temperature'},
+                  'entity_id': 'sensor.outside_temperature',
+                  'state': '21.5'},
+                 {'attributes': {'friendly_name': 'Quote " and { brace }'},
+                  'entity_id': 'sensor.tricky', 'state': '\\'}])
+
+
+class TestHaClientMulti(TestCase):
+
+    def setUp(self):
+        self.ha = HomeAssistantClient('http://192.168.0.1:8123', 'password')
+        self.ha._fetch_state = mock.MagicMock(return_value=group_states)
+
+    def test_all_of_a_domain(self):
+        entities = self.ha.find_all_entities('lights', ['light', 'switch'])
+        self.assertEqual([e.entity_id for e in entities],
+                         ['light.kitchen_lights', 'light.bedroom'])
+
+    def test_domain_word_filters_group_members(self):
+        entities = self.ha.find_all_entities('kitchen lights',
+                                             ['light', 'switch'])
+        self.assertEqual([e.entity_id for e in entities],
+                         ['light.kitchen_lights'])
+
+    def test_all_needs_a_name(self):
+        self.assertEqual(self.ha.find_all_entities('', ['light', 'switch']),
+                         [])
+        self.assertEqual(self.ha.find_all_entities('  ', 'light'), [])
+
+    def test_all_members_of_nested_group(self):
+        entities = self.ha.find_all_entities('kitchen', ['light', 'switch'])
+        self.assertEqual([e.entity_id for e in entities],
+                         ['light.kitchen_lights', 'switch.kitchen_fan'])
+
+    @mock.patch('requests.Session.post')
+    def test_one_call_per_domain(self, mock_post):
+        self.ha.execute_service_multi(
+            'turn_off', ['light.kitchen_lights', 'switch.kitchen_fan',
+                         'light.bedroom'])
+        calls = sorted((c[0][0], json.loads(c[1]['data']))
+                       for c in mock_post.call_args_list)
+        self.assertEqual(calls, [
+            ('http://192.168.0.1:8123/api/services/light/turn_off',
+             {'entity_id': ['light.kitchen_lights', 'light.bedroom']}),
+            ('http://192.168.0.1:8123/api/services/switch/turn_off',
+             {'entity_id': ['switch.kitchen_fan']})])
+
+
+class TestEntityIndex(TestCase):
+
+    def test_normalized_ratio_is_token_sort_ratio(self):
+        for a, b in [('temperature outside', 'Outside Temperature'),
+                     ('kitchen', 'light.kitchen_lights'),
+                     ('Küche Licht', 'licht küche')]:
+            self.assertEqual(fuzz.ratio(normalize(a), normalize(b)),
+                             fuzz.token_sort_ratio(a, b))
+
+    def test_prefilter_keeps_best_match(self):
+        rooms = ['Kitchen', 'Bedroom', 'Office', 'Hallway', 'Garage']
+        many = [{'entity_id': 'light.lamp_{}'.format(i),
+                 'attributes': {'friendly_name': '{} Lamp {}'.format(
+                     rooms[i % len(rooms)], i)},
+                 'state': 'off'} for i in range(1000)]
+        many.append(json_data)
+        index = EntityIndex(Entity.from_state(s) for s in many)
+        candidates = index.candidates(normalize('kitchen lights'), ['light'])
+        self.assertLessEqual(len(candidates), MAX_CANDIDATES)
+        self.assertIn('light.kitchen_lights', [c[0] for c in candidates])
+        self.assertEqual(index.candidates(normalize('kitchen'), ['switch']),
+                         [])
+
+    @unittest.skipIf(cdist is None, 'rapidfuzz is not installed')
+    def test_batched_scorer_matches_fuzzywuzzy(self):
+        names = ['Kitchen Lights', 'Kitchen Lamp', 'Bedroom Light',
+                 'Office Fan', 'Outside Temperature', 'Hallway Spot 3']
+        index = EntityIndex(
+            [Entity('light.{}'.format(n.lower().replace(' ', '_')), 'on',
+                    {'friendly_name': n}) for n in names])
+        for query in ['kitchen light', 'bed room', 'temperature outside',
+                      'hall spot', 'nothing like it']:
+            for partial, threshold in ((False, 50), (True, None)):
+                self.assertEqual(
+                    index.best_match(normalize(query), ['light'],
+                                     RapidfuzzScorer(), partial=partial,
+                                     threshold=threshold),
+                    index.best_match(normalize(query), ['light'],
+                                     FuzzywuzzyScorer(), partial=partial,
+                                     threshold=threshold))
+
+
+class TestHaClientSession(TestCase):
+
+    def test_pooled_session(self):
+        ha = HomeAssistantClient('https://192.168.0.1:8123', 'password',
+                                 verify=False, pool_size=8, retries=3)
+        adapter = ha.session.get_adapter('https://192.168.0.1:8123/api/')
+        self.assertEqual(adapter._pool_maxsize, 8)
+        self.assertEqual(adapter.max_retries.total, 3)
+        self.assertEqual(ha.session.headers['x-ha-access'], 'password')
+        self.assertFalse(ha.session.verify)
+
+    @mock.patch('requests.Session.close')
+    def test_close(self, mock_close):
+        ha = HomeAssistantClient('http://192.168.0.1:8123', 'password')
+        ha.close()
+        mock_close.assert_called_once_with()
+
+
+class TestServiceDispatcher(TestCase):
+
+    def test_calls_run_in_order_through_runner(self):
+        calls = []
+
+        def runner(callback, *args, **kwargs):
+            try:
+                return callback(*args, **kwargs)
+            except ValueError as e:
+                calls.append(('error', str(e)))
+
+        def fail():
+            raise ValueError('offline')
+
+        dispatcher = ServiceDispatcher(runner)
+        dispatcher.dispatch(calls.append, 'first')
+        dispatcher.dispatch(fail)
+        dispatcher.dispatch(calls.append, 'last')
+        dispatcher.stop()
+        self.assertEqual(calls, ['first', ('error', 'offline'), 'last'])
+
+
+class FakeWebsocket(object):
+    """Stand-in for a Home Assistant websocket connection"""
+
+    def __init__(self, states, answer_pings=True):
+        self.sent = []
+        self.answer_pings = answer_pings
+        self.timeout = None
+        self.incoming = queue.Queue()
+        for msg in [{'type': 'auth_required'}, {'type': 'auth_ok'},
+                    {'id': 1, 'type': 'result', 'success': True,
+                     'result': None},
+                    {'id': 2, 'type': 'result', 'success': True,
+                     'result': states}]:
+            self.push(msg)
+
+    def push(self, msg):
+        self.incoming.put(json.dumps(msg))
+
+    def send(self, raw):
+        msg = json.loads(raw)
+        self.sent.append(msg)
+        if msg['type'] == 'ping' and self.answer_pings:
+            self.push({'id': msg['id'], 'type': 'pong'})
+
+    def recv(self):
+        try:
+            return self.incoming.get(timeout=self.timeout or 5)
+        except queue.Empty:
+            raise WebSocketTimeoutException('timed out')
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def close(self):
+        self.incoming.put('')
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+@unittest.skipIf(WebSocketTimeoutException is None,
+                 'websocket-client is not installed')
+class TestHaClientWebsocket(TestCase):
+
+    def setUp(self):
+        self.connections = []
+        self.answer_pings = True
+        patcher = mock.patch('ha_websocket.create_connection',
+                             side_effect=self._connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _connect(self, url, **kwargs):
+        self.assertEqual(url, 'ws://192.168.0.1:8123/api/websocket')
+        # only the first connection goes silent if told to
+        ws = FakeWebsocket(states, answer_pings=bool(self.connections) or
+                           self.answer_pings)
+        self.connections.append(ws)
+        return ws
+
+    @mock.patch('requests.Session.get')
+    def test_mirror_answers_lookups(self, mock_get):
+        ha = HomeAssistantClient('http://192.168.0.1:8123', 'password',
+                                 websocket=True)
+        self.addCleanup(ha.close)
+        self.assertTrue(wait_for(lambda: ha._mirror.synced))
+        self.assertEqual(self.connections[0].sent[0],
+                         {'type': 'auth', 'api_password': 'password'})
+        new_state = dict(json_data, state='on')
+        self.connections[0].push({'id': 1, 'type': 'event', 'event': {
+            'data': {'entity_id': 'light.kitchen_lights',
+                     'new_state': new_state}}})
+        self.assertTrue(wait_for(
+            lambda: ha.find_entity('kitchen lights', ['light'])['state'] ==
+            'on'))
+        self.assertEqual(mock_get.call_count, 0)
+
+    def test_loaded_component_clears_conversation_cache(self):
+        ha = HomeAssistantClient('http://192.168.0.1:8123', 'password',
+                                 websocket=True)
+        self.addCleanup(ha.close)
+        self.assertTrue(wait_for(lambda: ha._mirror.synced))
+        ha._not_understood.put('blah', {'speech': 'Sorry'})
+        self.connections[0].push({'id': 3, 'type': 'event', 'event': {
+            'event_type': 'component_loaded',
+            'data': {'component': 'intent_script'}}})
+        self.assertTrue(wait_for(lambda: len(ha._not_understood) == 0))
+
+    @mock.patch('ha_websocket.RECONNECT_DELAY', 0)
+    def test_mirror_resyncs_after_drop(self):
+        ha = HomeAssistantClient('http://192.168.0.1:8123', 'password',
+                                 websocket=True)
+        self.addCleanup(ha.close)
+        self.assertTrue(wait_for(lambda: ha._mirror.synced))
+        self.connections[0].close()
+        self.assertTrue(wait_for(
+            lambda: len(self.connections) == 2 and ha._mirror.synced))
+        self.assertEqual(len(ha._get_state()), len(states))
+
+    @mock.patch('ha_websocket.PING_INTERVAL', 0.05)
+    @mock.patch('ha_websocket.PONG_TIMEOUT', 0.05)
+    def test_mirror_pings(self):
+        ha = HomeAssistantClient('http://192.168.0.1:8123', 'password',
+                                 websocket=True)
+        self.addCleanup(ha.close)
+        self.assertTrue(wait_for(lambda: ha._mirror.synced))
+        pings = lambda: [m for m in self.connections[0].sent
+                         if m['type'] == 'ping']
+        self.assertTrue(wait_for(lambda: len(pings()) >= 3))
+        self.assertEqual([m['id'] for m in pings()[:3]], [4, 5, 6])
+        self.assertEqual(len(self.connections), 1)
+
+    @mock.patch('ha_websocket.RECONNECT_DELAY', 0)
+    @mock.patch('ha_websocket.PING_INTERVAL', 0.05)
+    @mock.patch('ha_websocket.PONG_TIMEOUT', 0.05)
+    def test_mirror_resyncs_without_pong(self):
+        self.answer_pings = False
+        ha = HomeAssistantClient('http://192.168.0.1:8123', 'password',
+                                 websocket=True)
+        self.addCleanup(ha.close)
+        self.assertTrue(wait_for(
+            lambda: len(self.connections) == 2 and ha._mirror.synced))
+
+
+class TestConversationCache(TestCase):
+
+    def setUp(self):
+        self.server = FakeHomeAssistant(states).start()
+        self.addCleanup(self.server.stop)
+        self.ha = HomeAssistantClient(self.server.url, 'password')
+        self.addCleanup(self.ha.close)
+
+    def conversations(self):
+        counters = {(c['name'], tuple(c['labels'].items())): c['value']
+                    for c in self.ha.metrics.snapshot()['counters']}
+        return counters.get(('requests_total', (('endpoint', 'conversation'),
+                                                ('status', '200'))), 0)
+
+    def test_not_understood_is_cached(self):
+        answer = self.ha.engage_conversation('Blah blah.')
+        self.assertEqual(self.ha.engage_conversation('blah  BLAH'), answer)
+        self.assertEqual(self.conversations(), 1)
+        # new components clear the cache
+        self.ha.find_component('conversation')
+        self.server.components.append('intent_script')
+        self.ha.find_component('conversation')
+        self.ha.engage_conversation('blah blah')
+        self.assertEqual(self.conversations(), 2)
+
+    def test_components_are_checked_again(self):
+        self.ha.find_component('conversation')
+        self.ha.engage_conversation('blah blah')
+        self.server.components.append('intent_script')
+        self.ha.engage_conversation('blah blah')
+        self.assertEqual(self.conversations(), 1)
+        with mock.patch('ha_client.COMPONENT_CHECK_INTERVAL', 0):
+            self.ha.engage_conversation('blah blah')
+        self.assertEqual(self.conversations(), 2)
+
+    def test_understood_is_always_sent(self):
+        with mock.patch.object(self.server, 'conversation',
+                               return_value='Turned on the light'):
+            self.ha.engage_conversation('turn on the light')
+            self.ha.engage_conversation('turn on the light')
+        self.assertEqual(self.conversations(), 2)
+
+
+class TestMetrics(TestCase):
+
+    def test_prometheus_text(self):
+        metrics = Metrics()
+        metrics.request('states', 200, 0.02, 2048)
+        metrics.request('states', 'Timeout', 10.0)
+        metrics.inc('state_cache_total', result='hit')
+        text = metrics.prometheus()
+        self.assertIn('# TYPE homeassistant_request_seconds histogram\n',
+                      text)
+        self.assertIn('homeassistant_requests_total{endpoint="states",'
+                      'status="Timeout"} 1\n', text)
+        self.assertIn('homeassistant_request_seconds_bucket{'
+                      'endpoint="states",le="0.025"} 1\n', text)
+        self.assertIn('homeassistant_request_seconds_bucket{'
+                      'endpoint="states",le="+Inf"} 2\n', text)
+        self.assertIn('homeassistant_request_seconds_count{'
+                      'endpoint="states"} 2\n', text)
+        self.assertIn('homeassistant_response_bytes_sum{'
+                      'endpoint="states"} 2048', text)
+
+    @mock.patch('requests.Session.get')
+    def test_client_records_requests_and_cache(self, mock_get):
+        mock_get.return_value = response(states)
+        ha = HomeAssistantClient('http://192.168.0.1:8123', 'password')
+        ha.find_entity('kitchen lights', ['light'])
+        ha.find_entity('outside temperature', ['sensor'])
+        counters = {(c['name'], tuple(sorted(c['labels'].items()))):
+                    c['value'] for c in ha.metrics.snapshot()['counters']}
+        self.assertEqual(counters, {
+            ('requests_total', (('endpoint', 'states'), ('status', '200'))):
+                1,
+            ('state_cache_total', (('result', 'miss'),)): 1,
+            ('state_cache_total', (('result', 'hit'),)): 1})
+        histograms = {h['name']: h['count']
+                      for h in ha.metrics.snapshot()['histograms']}
+        self.assertEqual(histograms['match_seconds'], 2)
+        self.assertEqual(histograms['index_build_seconds'], 1)
+
+
+class TestJsonCodec(TestCase):
+
+    def test_round_trip(self):
+        data = {'entity_id': 'sensor.außen', 'attributes': {'value': 1.5}}
+        encoded = ha_json.dumps(data)
+        self.assertIsInstance(encoded, bytes)
+        self.assertEqual(ha_json.loads(encoded), data)
+        self.assertEqual(ha_json.loads(encoded.decode()), data)
+        with self.assertRaises(ValueError):
+            ha_json.loads(b'{"broken"')
+
+
+class TestUnitNames(TestCase):
+
+    def test_common_units_are_not_parsed(self):
+        units = UnitNames()
+        units._parser = mock.Mock()
+        self.assertEqual(units.name('°C'), 'degree Celsius')
+        self.assertEqual(units.name(''), '')
+        self.assertFalse(units._parser.parse.called)
+
+    def test_parsed_once_per_unit(self):
+        units = UnitNames()
+        quantity = mock.Mock(uncertainty=0)
+        quantity.unit.name = 'microgram per cubic metre'
+        units._parser = mock.Mock()
+        units._parser.parse.return_value = [quantity]
+        self.assertEqual(units.name('µg/m³'), 'microgram per cubic metre')
+        self.assertEqual(units.name('µg/m³'), 'microgram per cubic metre')
+        self.assertEqual(units._parser.parse.call_count, 1)
+
+    def test_unit_kept_without_parser(self):
+        units = UnitNames()
+        units._parser = None
+        self.assertEqual(units.name('µg/m³'), 'µg/m³')
+
+
+class TestAdaptiveTimeouts(TestCase):
+
+    def test_timeouts_follow_latency(self):
+        timeouts = AdaptiveTimeouts(10)
+        self.assertEqual(timeouts.timeout('services'), 10)
+        self.assertIsNone(timeouts.hedge_delay('services'))
+        for _ in range(MIN_SAMPLES):
+            timeouts.observe('services', 0.05)
+            timeouts.observe('states', 9)
+        self.assertEqual(timeouts.timeout('services'), MIN_TIMEOUT)
+        self.assertEqual(timeouts.hedge_delay('services'), 0.05)
+        # large downloads may take longer than the default
+        self.assertEqual(timeouts.timeout('states'), 30)
+        # timed out requests make the next timeout longer
+        timeouts.observe('services', MIN_TIMEOUT)
+        self.assertEqual(timeouts.timeout('services'), 4 * MIN_TIMEOUT)
+        # service calls take as long as the service, whatever they took
+        self.assertEqual(timeouts.timeout('services', 'post'), 10)
+
+    def test_hedged_read_takes_first_answer(self):
+        ha = HomeAssistantClient('http://192.168.0.1:8123', 'password',
+                                 hedge=True)
+        self.addCleanup(ha.close)
+        for _ in range(MIN_SAMPLES):
+            ha.timeouts.observe('components', 0.01)
+        calls = []
+
+        def send(method, endpoint, path, **kwargs):
+            calls.append(path)
+            if len(calls) == 1:
+                time.sleep(0.5)
+                return 'slow'
+            return 'fast'
+
+        with mock.patch.object(ha, '_send', side_effect=send):
+            self.assertEqual(
+                ha._request('get', 'components', '/api/components'), 'fast')
+            # writes are never sent twice
+            calls[:] = []
+            self.assertEqual(
+                ha._request('post', 'services', '/api/services/a/b'), 'slow')
+        self.assertEqual(calls, ['/api/services/a/b'])
+
+
+class TestFakeHomeAssistant(TestCase):
+
+    def setUp(self):
+        self.server = FakeHomeAssistant(states, seed=0).start()
+        self.addCleanup(self.server.stop)
+
+    @unittest.skipIf(WebSocketTimeoutException is None,
+                     'websocket-client is not installed')
+    def test_mirror_follows_service_calls(self):
+        ha = HomeAssistantClient(self.server.url, 'password',
+                                 websocket=True)
+        self.addCleanup(ha.close)
+        self.assertTrue(wait_for(lambda: ha._mirror.synced))
+        ha.execute_service('light', 'turn_on',
+                           {'entity_id': 'light.kitchen_lights'})
+        self.assertTrue(wait_for(
+            lambda: ha.find_entity('kitchen lights', ['light'])['state'] ==
+            'on'))
+        self.assertEqual(self.server.calls, [
+            ('light', 'turn_on', {'entity_id': 'light.kitchen_lights'})])
+
+    def test_injected_errors(self):
+        ha = HomeAssistantClient(self.server.url, 'password', retries=0)
+        self.addCleanup(ha.close)
+        self.server.errors = {503: 1.0}
+        with self.assertRaises(HTTPError) as cm:
+            ha.find_component('conversation')
+        self.assertEqual(cm.exception.response.status_code, 503)
+        # not wrapped into a ConnectionError by the retries
+        ha = HomeAssistantClient(self.server.url, 'password', timeout=0.1)
+        self.addCleanup(ha.close)
+        self.server.errors = {'timeout': 1.0}
+        self.server.hang = 1
+        with self.assertRaises(Timeout):
+            ha.find_component('conversation')
+
+    def test_states_compressed(self):
+        ha = HomeAssistantClient(self.server.url, 'password')
+        self.addCleanup(ha.close)
+        r = ha._request('get', 'states', '/api/states')
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(ha_json.loads(r.content), states)
+
+    def test_delta_refresh(self):
+        self.server.stop()
+        generated = generate_states(40)
+        self.server = FakeHomeAssistant(generated, seed=0).start()
+        self.addCleanup(self.server.stop)
+        ha = HomeAssistantClient(self.server.url, 'password', cache_ttl=0.01,
+                                 delta_refresh=True)
+        self.addCleanup(ha.close)
+
+        def requests(endpoint):
+            return sum(c['value'] for c in ha.metrics.snapshot()['counters']
+                       if c['name'] == 'requests_total' and
+                       c['labels']['endpoint'] == endpoint)
+        light = next(s['entity_id'] for s in generated
+                     if s['entity_id'].startswith('light.'))
+        sensor = next(s['entity_id'] for s in generated
+                      if s['entity_id'].startswith('sensor.'))
+        switch = next(s['entity_id'] for s in generated
+                      if s['entity_id'].startswith('switch.'))
+        ha.find_entities()
+        self.server.set_state(light, 'unavailable')
+        self.server.set_state(sensor, '42')
+        time.sleep(0.02)
+        by_id = {e.entity_id: e for e in ha.find_entities()}
+        self.assertEqual(by_id[light].state, 'unavailable')
+        self.assertEqual((requests('states'), requests('logbook'),
+                          requests('state')), (1, 1, 1))
+        # not in the logbook, fetched when read out
+        self.assertEqual(ha.find_entity_attr(sensor)['state'], '42')
+        self.assertEqual(requests('state'), 2)
+        # brightness changes of a light that is on are not logged either
+        self.server.set_state(light, 'on', {'brightness': 200})
+        # a later logged change, so the light's entry is not listed again
+        self.server.set_state(switch, 'unavailable')
+        time.sleep(0.02)
+        ha.find_entities()
+        ha.execute_service('light', 'turn_on',
+                           {'entity_id': light, 'brightness': 201})
+        # a fresh cache still holding brightness 200
+        ha.cache_ttl = 60
+        self.assertEqual(ha._get_state_map()[light].brightness, 200)
+        self.assertEqual(ha.find_entity_attr(light)['unit_measure'], 201)
+        ha.cache_ttl = 0.01
+        self.server.restart()
+        time.sleep(0.02)
+        ha.find_entities()
+        self.assertEqual(requests('states'), 2)
+
+    @mock.patch('ha_timeouts.MIN_TIMEOUT', 0.05)
+    def test_slow_service_call_does_not_time_out(self):
+        ha = HomeAssistantClient(self.server.url, 'password', timeout=2)
+        self.addCleanup(ha.close)
+        for _ in range(MIN_SAMPLES):
+            ha.execute_service('light', 'turn_on',
+                               {'entity_id': 'light.kitchen_lights'})
+        self.server.latency = 0.3
+        r = ha.execute_service('light', 'turn_off',
+                               {'entity_id': 'light.kitchen_lights'})
+        self.assertEqual(r.status_code, 200)
+
+    @mock.patch('ha_circuit.PROBE_INTERVAL', 0.05)
+    def test_circuit_opens_and_closes(self):
+        ha = HomeAssistantClient(self.server.url, 'password', timeout=0.1)
+        self.addCleanup(ha.close)
+        self.server.errors = {'timeout': 1.0}
+        self.server.hang = 0.5
+        for _ in range(ha.breaker.threshold):
+            with self.assertRaises(Timeout):
+                ha.find_component('conversation')
+        start = time.monotonic()
+        with self.assertRaises(CircuitOpenError):
+            ha.find_component('conversation')
+        self.assertLess(time.monotonic() - start, 0.05)
+        self.server.errors = {}
+        self.assertTrue(wait_for(lambda: not ha.breaker.is_open))
+        self.assertTrue(ha.find_component('conversation'))
+
+    def test_http_errors_keep_circuit_closed(self):
+        ha = HomeAssistantClient(self.server.url, 'password', retries=0)
+        self.addCleanup(ha.close)
+        self.server.errors = {500: 1.0}
+        for _ in range(ha.breaker.threshold + 1):
+            with self.assertRaises(HTTPError):
+                ha.find_component('conversation')
+        self.assertFalse(ha.breaker.is_open)
+
+    def test_ssl_errors_keep_circuit_closed(self):
+        url = self.server.url.replace('http:', 'https:')
+        ha = HomeAssistantClient(url, 'password', retries=0)
+        self.addCleanup(ha.close)
+        for _ in range(ha.breaker.threshold + 1):
+            with self.assertRaises(SSLError):
+                ha.find_component('conversation')
+        self.assertFalse(ha.breaker.is_open)
+
+    def test_wrong_password(self):
+        ha = HomeAssistantClient(self.server.url, 'wrong')
+        self.addCleanup(ha.close)
+        with self.assertRaises(HTTPError) as cm:
+            ha.find_entity('kitchen lights', ['light'])
+        self.assertEqual(cm.exception.response.status_code, 401)
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestSyncHomeAssistantClient(TestCase):
+
+    def setUp(self):
+        self.server = FakeHomeAssistant(states).start()
+        self.addCleanup(self.server.stop)
+        self.url = self.server.url
+
+    def test_requests_on_event_loop(self):
+        ha = SyncHomeAssistantClient(self.url, 'password')
+        self.addCleanup(ha.close)
+        entity = ha.find_entity('kitchen lights', ['light'])
+        self.assertEqual(entity['id'], 'light.kitchen_lights')
+        r = ha.execute_service('light', 'turn_on',
+                               {'entity_id': entity['id']})
+        self.assertEqual(r.status_code, 200)
+        attr = ha.find_entity_attr('sensor.outside_temperature')
+        self.assertEqual(attr['state'], '21.5')
+        self.assertIsNone(ha._fetch_entity_state('sensor.missing'))
+        reply = ha.engage_conversation('hello')
+        self.assertIn('speech', reply)
+        future = ha.submit('engage_conversation', 'overlap')
+        self.assertEqual(future.result(5), reply)
+
+    def test_http_error_is_requests_error(self):
+        ha = SyncHomeAssistantClient(self.url, 'wrong')
+        self.addCleanup(ha.close)
+        with self.assertRaises(HTTPError) as cm:
+            ha.execute_service('light', 'turn_on')
+        self.assertEqual(cm.exception.response.status_code, 401)
+
+    @mock.patch('requests.Session.get',
+                side_effect=AssertionError('blocking request'))
+    def test_streamed_states_on_event_loop(self, mock_get):
+        ha = SyncHomeAssistantClient(self.url, 'password', cache_ttl=0)
+        self.addCleanup(ha.close)
+        entity = ha.find_entity('kitchen lights', ['light'])
+        self.assertEqual(entity['id'], 'light.kitchen_lights')
+        self.assertEqual(
+            [e.entity_id for e in ha.find_entities(domain='sensor')],
+            ['sensor.outside_temperature'])
+        self.server.errors = {503: 1.0}
+        with self.assertRaises(HTTPError):
+            ha.find_entity('kitchen lights', ['light'])
+
+    def test_connection_error_names_the_url(self):
+        ha = SyncHomeAssistantClient('http://127.0.0.1:1', 'password')
+        self.addCleanup(ha.close)
+        with self.assertRaises(ConnectionError) as cm:
+            ha.find_component('conversation')
+        self.assertEqual(cm.exception.request.url,
+                         'http://127.0.0.1:1/api/components')
+
+
+def load_skill():
+    """The skill module, loaded like mycroft does, None without mycroft"""
+    try:
+        import mycroft  # noqa: F401
+    except ImportError:
+        return None
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    spec = importlib.util.spec_from_file_location(
+        'homeassistant_skill', os.path.join(root, '__init__.py'),
+        submodule_search_locations=[root])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class TestSkillHandlers(TestCase):
+
+    def setUp(self):
+        self.skill_module = load_skill()
+        if self.skill_module is None:
+            self.skipTest('mycroft is not installed')
+
+    def test_async_connection_error_is_spoken(self):
+        ha = SyncHomeAssistantClient('http://127.0.0.1:1', 'password')
+        self.addCleanup(ha.close)
+        skill = mock.Mock()
+        handled = self.skill_module.HomeAssistantSkill \
+            ._handle_client_exception(skill, ha.find_component,
+                                      'conversation')
+        self.assertFalse(handled)
+        skill.speak_dialog.assert_called_once_with(
+            'homeassistant.error',
+            data={'url': 'http://127.0.0.1:1/api/components'})
+
+    def test_bare_all_is_no_switch_all(self):
+        skill_class = self.skill_module.HomeAssistantSkill
+        skill = mock.Mock()
+        skill.translate_list.return_value = ['all', 'all the']
+        skill._strip_all_keyword = functools.partial(
+            skill_class._strip_all_keyword, skill)
+        for name in ('all', 'all the'):
+            self.assertFalse(skill_class._switch_all(
+                skill, name, 'turn_off', ['light', 'switch']))
+        self.assertFalse(skill.client.find_all_entities.called)
+        skill.client.find_all_entities.return_value = [
+            Entity.from_state(json_data)]
+        self.assertTrue(skill_class._switch_all(
+            skill, 'all lights', 'turn_off', ['light', 'switch']))
+        skill.client.find_all_entities.assert_called_once_with(
+            'lights', ['light', 'switch'])
+        # no such group, looked up as a single entity
+        skill.client.find_all_entities.return_value = []
+        self.assertFalse(skill_class._switch_all(
+            skill, 'all bedroom lights', 'turn_off', ['light', 'switch']))
+        self.assertFalse(skill.speak_dialog.called)
+
+
 if __name__ == '__main__':
     unittest.main()
 